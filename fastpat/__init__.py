@@ -1,12 +1,21 @@
 from .tools.fetch import fetch_many
 from .tools.concat import concat_tables
+from .tools.parse import run_jobs
 from .tools.tables import read_csv
 
-from .parse.apply import parse_many as parse_apply
-from .parse.grant import parse_many as parse_grant
-from .parse.assign import parse_many as parse_assign
+from .parse.apply import (
+    parse_many as parse_apply, plan_many as plan_apply, sync_many as sync_apply
+)
+from .parse.grant import (
+    parse_many as parse_grant, plan_many as plan_grant, sync_many as sync_grant
+)
+from .parse.assign import (
+    parse_many as parse_assign, plan_many as plan_assign, sync_many as sync_assign
+)
 from .parse.maint import parse_many as parse_maint
-from .parse.tmapply import parse_many as parse_tmapply
+from .parse.tmapply import (
+    parse_many as parse_tmapply, plan_many as plan_tmapply, sync_many as sync_tmapply
+)
 from .parse.compustat import parse_many as parse_compustat
 
 from .firms.cluster import cluster_firms
@@ -6,10 +6,13 @@ import fire
 from importlib import resources
 from pathlib import Path
 
+from .tools.metrics import load_metrics, summarize_metrics
+from .parse.grant import engines
 from . import (
     fetch_many, concat_tables, parse_apply, parse_grant, parse_assign,
-    parse_assign, parse_maint, parse_tmapply, parse_compustat, cluster_firms,
-    prune_assign, aggregate_cites, merge_firms
+    parse_assign, parse_maint, parse_tmapply, parse_compustat, sync_apply,
+    sync_grant, sync_assign, sync_tmapply, plan_apply, plan_grant, plan_assign,
+    plan_tmapply, run_jobs, cluster_firms, prune_assign, aggregate_cites, merge_firms
 )
 
 # parser dispatcher
@@ -22,6 +25,22 @@ parsers = {
     'compustat': parse_compustat,
 }
 
+# sources parsed in one shared worker pool by "parse all"
+planners = {
+    'apply': plan_apply,
+    'grant': plan_grant,
+    'assign': plan_assign,
+    'tmapply': plan_tmapply,
+}
+
+# pipelined fetch and parse (multi-file sources only)
+syncers = {
+    'apply': sync_apply,
+    'grant': sync_grant,
+    'assign': sync_assign,
+    'tmapply': sync_tmapply,
+}
+
 # get path with fallbacks
 def get_path(path, env):
     if path is None:
@@ -50,40 +69,148 @@ class Main:
         if self.metapath is None:
             self.metapath = resources.files('fastpat') / 'meta'
 
-    def stat(self):
+    def stat(self, ftype=None, slowest=5):
         print(f'datapath: {self.datapath}')
         print(f'metapath: {self.metapath}')
 
-    def fetch(self, ftype, files=None, delay=10, overwrite=False, unzip=False, dryrun=False):
+        # parse metrics by source
+        pardir = self.datapath / 'parsed'
+        sources = [ftype] if ftype is not None else sorted(parsers)
+        for src in sources:
+            frame = load_metrics(pardir / src)
+            if len(frame) == 0:
+                continue
+            summ, slow = summarize_metrics(frame, slowest=slowest)
+            print(f'\n{src}: by version and generation')
+            print(summ.to_string())
+            print(f'\n{src}: slowest files (MB/s)')
+            print(slow.to_string(index=False))
+
+    def urls(self, ftype, files=None):
         if files is None:
             fpath = self.metapath / f'{ftype}_files.txt'
         else:
             fpath = Path(files)
-        flist = get_lines(fpath)
+        return get_lines(fpath)
 
+    def fetch(
+        self, ftype, files=None, threads=4, rate=0.2, overwrite=False, revalidate=False,
+        unzip=False, dryrun=False
+    ):
+        flist = self.urls(ftype, files=files)
         output = self.datapath / 'raw' / ftype
-        fetch_many(flist, output, delay=delay, overwrite=overwrite, unzip=unzip, dryrun=dryrun)
-
-    def parse(self, ftype, path=None, concat=True, overwrite=False, dryrun=False, threads=10):
+        fetch_many(
+            flist, output, threads=threads, rate=rate, overwrite=overwrite,
+            revalidate=revalidate, unzip=unzip, dryrun=dryrun
+        )
+
+    def parse(
+        self, ftype, path=None, concat=True, overwrite=False, dryrun=False, threads=10, split=256,
+        engine=None, fields=None, no_text=False, max_tasks=None, max_rss=None, max_memory=None,
+        format='csv', dedup=False, virtual=False
+    ):
         if path is None:
             path = self.datapath / 'raw' / ftype
         pardir = self.datapath / 'parsed' / ftype
         tabdir = self.datapath / 'tables'
 
-        if ftype in parsers:
-            parsers[ftype](path, pardir, overwrite=overwrite, dryrun=dryrun, threads=threads)
+        # alternative parse engines (grant only)
+        opts = {}
+        if engine is not None:
+            if ftype not in ['grant', 'all']:
+                print(f'Error: no parse engines for "{ftype}"')
+                return
+            if engine not in engines:
+                print(f'Error: unknown parse engine "{engine}" (one of {", ".join(engines)})')
+                return
+            opts['engine'] = engine
+
+        # column selection (sources with free text only)
+        if fields is not None or no_text:
+            if ftype not in ['grant', 'apply']:
+                print(f'Error: no field selection for "{ftype}"')
+                return
+            opts['fields'] = fields
+            opts['text'] = not no_text
+
+        # worker recycling and memory budget (in megabytes)
+        limits = {}
+        if max_tasks is not None or max_rss is not None or max_memory is not None:
+            if ftype not in planners and ftype != 'all':
+                print(f'Error: no worker limits for "{ftype}"')
+                return
+            limits['max_tasks'] = max_tasks
+            limits['max_rss'] = None if max_rss is None else max_rss*2**20
+            limits['max_memory'] = None if max_memory is None else max_memory*2**20
+
+        if ftype == 'all':
+            # files of all sources go into one pool, largest first
+            sources = [src for src in planners if (self.datapath / 'raw' / src).exists()]
+            jobs = [
+                planners[src](
+                    self.datapath / 'raw' / src, self.datapath / 'parsed' / src,
+                    overwrite=overwrite, dryrun=dryrun, split=split*2**20, format=format,
+                    **(opts if src == 'grant' else {})
+                ) for src in sources
+            ]
+            run_jobs(jobs, threads=threads, **limits)
+            if concat:
+                for src in sources:
+                    concat_tables(
+                        self.datapath / 'parsed' / src, tabdir, src, format=format, dedup=dedup,
+                        virtual=virtual
+                    )
+        elif ftype in parsers:
+            parsers[ftype](
+                path, pardir, overwrite=overwrite, dryrun=dryrun, threads=threads,
+                split=split*2**20, format=format, **opts, **limits
+            )
+            if concat:
+                concat_tables(
+                    pardir, tabdir, ftype, format=format, dedup=dedup, virtual=virtual
+                )
+        else:
+            print(f'Error: unknown data source "{ftype}"')
+
+    def sync(
+        self, ftype, files=None, threads=10, fetch_threads=4, rate=0.2, queue=None,
+        revalidate=False, concat=True, overwrite=False, dryrun=False, format='csv', dedup=False,
+        virtual=False
+    ):
+        rawdir = self.datapath / 'raw' / ftype
+        pardir = self.datapath / 'parsed' / ftype
+        tabdir = self.datapath / 'tables'
+
+        if ftype in syncers:
+            flist = self.urls(ftype, files=files)
+            syncers[ftype](
+                flist, rawdir, pardir, threads=threads, fetch_threads=fetch_threads, rate=rate,
+                queue=queue, revalidate=revalidate, overwrite=overwrite, dryrun=dryrun,
+                format=format
+            )
             if concat:
-                concat_tables(pardir, tabdir, ftype)
+                concat_tables(
+                    pardir, tabdir, ftype, format=format, dedup=dedup, virtual=virtual
+                )
+        elif ftype in parsers:
+            self.fetch(
+                ftype, files=files, threads=fetch_threads, rate=rate, revalidate=revalidate,
+                dryrun=dryrun
+            )
+            self.parse(
+                ftype, concat=concat, overwrite=overwrite, dryrun=dryrun, threads=threads,
+                format=format, dedup=dedup, virtual=virtual
+            )
         else:
             print(f'Error: unknown data source "{ftype}"')
 
-    def firms(self, action, sources=None, compustat=False):
+    def firms(self, action, sources=None, compustat=False, max_bucket=None):
         tabdir = self.datapath / 'tables'
 
         if action == 'assign':
             prune_assign(tabdir)
         elif action == 'cluster':
-            cluster_firms(tabdir, sources=sources)
+            cluster_firms(tabdir, sources=sources, max_bucket=max_bucket)
         elif action == 'cites':
             aggregate_cites(tabdir)
         elif action == 'merge':
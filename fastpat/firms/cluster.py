@@ -5,14 +5,12 @@ import os
 import numpy as np
 import pandas as pd
 import networkx as nx
-from math import ceil
 from itertools import chain, repeat
 from collections import defaultdict
-from editdistance import eval as levenshtein
 
 from ..tools.standardize import standardize_weak, standardize_strong
 from ..tools.tables import read_csv
-from ..tools.simhash import shingle, Cluster
+from ..tools.simhash import HashVocab, simhash_names, levenshtein_within, Cluster
 
 # firm name sources - tag: (table, id_col, name_col)
 colmap = {
@@ -54,28 +52,25 @@ def generate_names(output, sources=None):
 
     print(f'found {len(names)} names')
 
-# k = 8, thresh = 4 works well
-def filter_pairs(output, nshingle=2, k=8, thresh=4):
+# k = 8, thresh = 4 works well. buckets over max_bucket names (if set) only match neighbors
+def filter_pairs(output, nshingle=2, k=8, thresh=4, max_bucket=None, window=100):
     print('filtering pairs')
 
-    c = Cluster(k=k, thresh=thresh)
-    name_dict = {}
+    c = Cluster(
+        k=k, thresh=thresh, vocab=HashVocab(), max_bucket=max_bucket, window=window
+    )
 
     npath = os.path.join(output, 'name.csv')
     names = read_csv(npath, usecols=['id', 'name'])
 
-    for i, id, name in names.itertuples():
-        words = name.split()
-        shings = list(shingle(name, nshingle))
+    # signatures of all names in one pass
+    signs = simhash_names(names['name'], nshingle=nshingle, vocab=c.vocab)
+    c.vocab.report()
 
-        features = shings + words
-        weights = list(np.linspace(1.0, 0.0, len(shings))) + list(np.linspace(1.0, 0.0, len(words)))
-
-        c.add(features, weights=weights, label=id)
-        name_dict[id] = name
-
-        if i > 0 and i % 100_000 == 0:
-            print(f'{i}: {len(c.unions)}')
+    # banded matching on all of them at once
+    c.insert_many(signs, names['id'].to_numpy())
+    name_dict = dict(zip(names['id'], names['name']))
+    c.report(names=name_dict)
 
     ppath = os.path.join(output, 'pair.csv')
     pairs = pd.DataFrame([
@@ -85,32 +80,36 @@ def filter_pairs(output, nshingle=2, k=8, thresh=4):
 
     print('Found %i pairs' % len(pairs))
 
-# compute distances on owners in same cluster
+# compute distances on owners in same cluster. only distances up to the most a close pair
+# can have are computed, and pairs whose lengths differ by more are rejected outright
 def find_groups(output, thresh=0.85):
     print('finding matches')
 
-    def dmetr(name1, name2):
-        max_len = max(len(name1), len(name2))
-        max_dist = int(ceil(max_len*(1.0-thresh)))
-        ldist = levenshtein(name1, name2)
-        return (1.0 - float(ldist)/max_len) if (ldist != -1 and max_len != 0) else 0.0
-
-    close = []
-    name_std = {}
-
     ppath = os.path.join(output, 'pair.csv')
     pairs = read_csv(ppath, usecols=['id1', 'id2', 'name1', 'name2'])
 
-    for i, id1, id2, name1, name2 in pairs.itertuples():
-        if id1 not in name_std:
-            name_std[id1] = standardize_strong(name1)
-        if id2 not in name_std:
-            name_std[id2] = standardize_strong(name2)
+    names = pd.concat([
+        pairs[['id1', 'name1']].set_axis(['id', 'name'], axis=1),
+        pairs[['id2', 'name2']].set_axis(['id', 'name'], axis=1),
+    ]).drop_duplicates('id')
+    name_std = dict(zip(names['id'], names['name'].map(standardize_strong)))
 
-        n1std = name_std[id1]
-        n2std = name_std[id2]
+    n1std = pairs['id1'].map(name_std)
+    n2std = pairs['id2'].map(name_std)
+    len1, len2 = n1std.str.len(), n2std.str.len()
+    max_len = np.maximum(len1, len2)
+    max_dist = np.ceil(max_len*(1.0-thresh)).astype(int)
+    keep = ((len1 - len2).abs() <= max_dist) & (max_len > 0)
+    print(f'rejected {(~keep).sum()} of {len(pairs)} pairs by length')
 
-        if dmetr(n1std, n2std) > thresh:
+    close = []
+    cands = zip(
+        pairs['id1'][keep], pairs['id2'][keep], n1std[keep], n2std[keep], max_len[keep],
+        max_dist[keep]
+    )
+    for i, (id1, id2, name1, name2, mlen, mdist) in enumerate(cands):
+        ldist = levenshtein_within(name1, name2, mdist)
+        if 1.0 - float(ldist)/mlen > thresh:
             close.append((id1, id2))
 
         if i > 0 and i % 100_000 == 0:
@@ -153,8 +152,8 @@ def merge_firms(output, sources=None, base=1000000):
         src[[id_col, 'firm_num']].to_csv(opath, index=False)
 
 # go through all steps
-def cluster_firms(output, sources=None):
+def cluster_firms(output, sources=None, max_bucket=None):
     generate_names(output, sources=sources)
-    filter_pairs(output)
+    filter_pairs(output, max_bucket=max_bucket)
     find_groups(output)
     merge_firms(output, sources=sources)
@@ -4,10 +4,17 @@ from itertools import chain
 
 from ..tools.tables import read_csv
 
+# grant columns used by the firm pipeline (the rest are optional, see --fields)
+required_grant = ['patnum', 'pubdate', 'ipc', 'owner']
+
 def merge_grants(output):
     print('Merging all grant data')
 
-    grant = read_csv(f'{output}/grant_grant.csv').set_index('patnum')
+    grant = read_csv(f'{output}/grant_grant.csv')
+    missing = [c for c in required_grant if c not in grant]
+    if len(missing) > 0:
+        raise Exception(f'Grants parsed without required fields: {", ".join(missing)}')
+    grant = grant.set_index('patnum')
     firm = read_csv(f'{output}/grant_firm.csv').set_index('patnum')
     cite = read_csv(f'{output}/cite_stats.csv').set_index('patnum')
     assign = read_csv(f'{output}/assign_stats.csv').set_index('patnum')
@@ -19,13 +26,17 @@ def merge_grants(output):
     grant = grant.join(maint)
 
     fill_cols = ['n_cited', 'n_citing', 'n_self_cited', 'n_self_citing', 'n_trans', 'claims']
+    fill_cols = [c for c in fill_cols if c in grant]
     grant[fill_cols] = grant[fill_cols].fillna(0).astype(np.int)
 
     int_cols = ['firm_num', 'last_maint']
     grant[int_cols] = grant[int_cols].astype('Int64')
 
-    grant.drop('abstract', axis=1).to_csv(f'{output}/grant_info.csv')
-    grant[['title', 'abstract']].to_csv(f'{output}/grant_text.csv')
+    # text is only split off when it was parsed (not with --no-text or --fields)
+    grant.drop('abstract', axis=1, errors='ignore').to_csv(f'{output}/grant_info.csv')
+    text_cols = [c for c in ['title', 'abstract'] if c in grant]
+    if len(text_cols) > 0:
+        grant[text_cols].to_csv(f'{output}/grant_text.csv')
 
 def generate_firmyear(output, compustat=False):
     print('Generating all firm-years')
@@ -2,87 +2,94 @@ import re
 import os
 import glob
 from collections import defaultdict
+from functools import partial
 from traceback import print_exc
-from multiprocessing import Pool
 
 from ..tools.parse import *
-from ..tools.tables import ChunkWriter, DummyWriter
-
-def parse_apply_gen2(elem, fname):
+from ..tools.tables import table_writers, check_format, DummyWriter
+from ..tools.metrics import ParseMetrics
+from ..tools.sync import sync_many as sync_pipeline
+
+# field paths (gen 2)
+fields_apply_gen2 = FieldExtractor(
+    scopes={
+        'bib': 'subdoc-bibliographic-information',
+        'pub': '$bib/document-id',
+        'app': '$bib/domestic-filing-data',
+        'tech': '$bib/technical-information',
+        'resid': '$bib/inventors/first-named-inventor/residence',
+        'address': ['$resid/residence-us', '$resid/residence-non-us'],
+    },
+    fields={
+        'pubnum': '$pub/doc-number',
+        'pubdate': '$pub/document-date',
+        'appnum': '$app/application-number/doc-number',
+        'appdate': '$app/filing-date',
+        'title': '$tech/title-of-invention',
+        'appname': '$bib/assignee/organization-name',
+        'city': '$address/city',
+        'state': '$address/state',
+        'country': '$address/country-code',
+    },
+)
+
+def parse_apply_gen2(elem, fname, skip=()):
     pat = defaultdict(str)
     pat['gen'] = 2
     pat['file'] = fname
 
-    # top-level section
-    bib = elem.find('subdoc-bibliographic-information')
-
-    # publication data
-    pub = bib.find('document-id')
-    if pub is not None:
-        pat['pubnum'] = get_text(pub, 'doc-number')
-        pat['pubdate'] = get_text(pub, 'document-date')
-
-    # application data
-    app = bib.find('domestic-filing-data')
-    if app is not None:
-        pat['appnum'] = get_text(app, 'application-number/doc-number')
-        pat['appdate'] = get_text(app, 'filing-date')
-
-    # title
-    tech = bib.find('technical-information')
-    pat['title'] = get_text(tech, 'title-of-invention')
+    # simple fields
+    pat.update(fields_apply_gen2(elem, skip))
 
     # ipc code
     pat['ipcs'] = []
-    ipcsec = tech.find('classification-ipc')
+    ipcsec = elem.find('subdoc-bibliographic-information/technical-information/classification-ipc')
     if ipcsec is not None:
         pat['ipcver'] = get_text(ipcsec, 'classification-ipc-edition').lstrip('0')
         pat['ipcs'] = [ip for ip in gen2_ipc(ipcsec)]
 
-    # assignee name
-    pat['appname'] = get_text(bib, 'assignee/organization-name')
-
-    # first inventor address
-    resid = bib.find('inventors/first-named-inventor/residence')
-    if resid is not None:
-        address = resid.find('residence-us')
-        if address is None:
-            address = resid.find('residence-non-us')
-        if address is not None:
-            pat['city'] = get_text(address, 'city')
-            pat['state'] = get_text(address, 'state')
-            pat['country'] = get_text(address, 'country-code')
-
     # abstract
-    abst = elem.find('subdoc-abstract')
+    abst = None if 'abstract' in skip else elem.find('subdoc-abstract')
     if abst is not None:
         pat['abstract'] = raw_text(abst, sep=' ')
 
     # roll it in
     return pat
 
-def parse_apply_gen3(elem, fname):
+# field paths (gen 3)
+fields_apply_gen3 = FieldExtractor(
+    scopes={
+        'bib': 'us-bibliographic-data-application',
+        'pubinfo': '$bib/publication-reference/document-id',
+        'appref': '$bib/application-reference',
+        'address': [
+            '$bib/parties/applicants/applicant/addressbook/address',
+            '$bib/us-parties/us-applicants/us-applicant/addressbook/address',
+        ],
+    },
+    fields={
+        'pubnum': '$pubinfo/doc-number',
+        'pubdate': '$pubinfo/date',
+        'appnum': '$appref/document-id/doc-number',
+        'appdate': '$appref/document-id/date',
+        'appname': '$bib/assignees/assignee/addressbook/orgname',
+        'title': '$bib/invention-title',
+        'city': '$address/city',
+        'state': '$address/state',
+        'country': '$address/country',
+    },
+)
+
+def parse_apply_gen3(elem, fname, skip=()):
     pat = defaultdict(str)
     pat['gen'] = 3
     pat['file'] = fname
 
+    # simple fields
+    pat.update(fields_apply_gen3(elem, skip))
+
     # top-level section
     bib = elem.find('us-bibliographic-data-application')
-    pubref = bib.find('publication-reference')
-    appref = bib.find('application-reference')
-
-    # published patent
-    pubinfo = pubref.find('document-id')
-    pat['pubnum'] = get_text(pubinfo, 'doc-number')
-    pat['pubdate'] = get_text(pubinfo, 'date')
-
-    # filing date
-    pat['appnum'] = get_text(appref, 'document-id/doc-number')
-    pat['appdate'] = get_text(appref, 'document-id/date')
-    pat['appname'] = get_text(bib, 'assignees/assignee/addressbook/orgname')
-
-    # title
-    pat['title'] = get_text(bib, 'invention-title')
 
     # ipc code
     pat['ipcs'] = []
@@ -96,17 +103,8 @@ def parse_apply_gen3(elem, fname):
             pat['ipcver'] = get_text(ipcsec, 'classification-ipcr/ipc-version-indicator/date')
             pat['ipcs'] = [ip for ip in gen3r_ipc(ipcsec)]
 
-    # first inventor address
-    address = bib.find('parties/applicants/applicant/addressbook/address')
-    if address is None:
-        address = bib.find('us-parties/us-applicants/us-applicant/addressbook/address')
-    if address is not None:
-        pat['city'] = get_text(address, 'city')
-        pat['state'] = get_text(address, 'state')
-        pat['country'] = get_text(address, 'country')
-
     # abstract
-    abspar = elem.find('abstract')
+    abspar = None if 'abstract' in skip else elem.find('abstract')
     if abspar is not None:
         pat['abstract'] = raw_text(abspar, sep=' ')
 
@@ -138,8 +136,11 @@ schema_ipc = {
     'version': 'str' # IPC version
 }
 
-# chunking express
-def store_patent(pat, chunker_pat, chunker_ipc):
+# fields other tables are keyed on
+required_apply = ['appnum', 'ipcver']
+
+# chunking express (schema is the projected apply schema)
+def store_patent(pat, chunker_pat, chunker_ipc, schema=schema_apply):
     an, iv = pat['appnum'], pat['ipcver']
 
     # store ipcs
@@ -148,34 +149,85 @@ def store_patent(pat, chunker_pat, chunker_ipc):
         chunker_ipc.insert(an, ipc, j, iv)
 
     # store patent
-    chunker_pat.insert(*(pat.get(k, '') for k in schema_apply))
+    chunker_pat.insert(*(pat.get(k, '') for k in schema))
 
-# file level
-def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
-    fdir, fname = os.path.split(fpath)
-    ftag, fext = os.path.splitext(fname)
+# output tables
+output_tables = ['apply', 'ipc']
 
-    opath_apply = os.path.join(output, f'apply_{ftag}.csv')
-    opath_ipc = os.path.join(output, f'ipc_{ftag}.csv')
+# document boundaries for splitting files
+def split_marker(fpath):
+    return b'<?xml'
 
-    complete = os.path.exists(opath_apply) and os.path.exists(opath_ipc)
-    if not overwrite and complete:
+# format generation of a source file
+def file_gen(fpath):
+    _, fname = os.path.split(fpath)
+    if fname.startswith('pab'):
+        return 2
+    elif fname.startswith('ipab'):
+        return 3
+
+# parser version of each generation, bump one when a change alters its output and only files
+# of that generation are re-parsed
+parser_versions = {2: 1, 3: 1}
+
+# what outputs are tagged with (see is_current)
+def parse_version(fpath, fields=None, text=True):
+    schema, _ = project_schema(schema_apply, fields=fields, text=text)
+    gen = file_gen(fpath)
+    return {'parser': f'apply.gen{gen}.v{parser_versions.get(gen)}', 'columns': list(schema)}
+
+# file level (span restricts to a byte range of the file)
+# fields selects the apply table columns (all if None), text=False drops the abstract
+# format is the output table format (see table_writers)
+def parse_file(
+    fpath, output, display=0, overwrite=False, dryrun=False, span=None, fields=None, text=True,
+    format='csv'
+):
+    fdir, fname = os.path.split(fpath)
+    ftag, fext = os.path.splitext(fname)
+    schema, skip = project_schema(
+        schema_apply, fields=fields, text=text, required=required_apply
+    )
+
+    opath_apply = output_path(output, 'apply', ftag, span=span, format=format)
+    opath_ipc = output_path(output, 'ipc', ftag, span=span, format=format)
+
+    # parts of split files are checked when planned
+    version = parse_version(fpath, fields=fields, text=text)
+    if span is None and not overwrite and is_current(
+        output, output_tables, fpath, version, format=format
+    ):
         print(f'{ftag}: Skipping')
         return
 
-    if fname.startswith('pab'):
-        parser = lambda fp: parse_wrapper(fp, 'patent-application-publication', parse_apply_gen2)
-    elif fname.startswith('ipab'):
-        parser = lambda fp: parse_wrapper(fp, 'us-patent-application', parse_apply_gen3)
+    metrics = ParseMetrics(fpath, span=span)
+    store = metrics.timed('write', store_patent)
+
+    gen = file_gen(fpath)
+    status = {}
+    if gen == 2:
+        extract = metrics.timed('extract', partial(parse_apply_gen2, skip=skip))
+        parser = lambda fp: parse_wrapper(
+            fp, 'patent-application-publication', extract, span=span, status=status
+        )
+    elif gen == 3:
+        extract = metrics.timed('extract', partial(parse_apply_gen3, skip=skip))
+        parser = lambda fp: parse_wrapper(
+            fp, 'us-patent-application', extract, span=span, status=status
+        )
     else:
         raise Exception(f'{ftag}: Unknown format')
 
+    if span is None and not dryrun:
+        drop_tag(output, fpath)
+
     if dryrun:
         chunker_apply = DummyWriter()
         chunker_ipc = DummyWriter()
     else:
-        chunker_apply = ChunkWriter(opath_apply, schema=schema_apply)
-        chunker_ipc = ChunkWriter(opath_ipc, schema=schema_ipc)
+        writer = table_writers[format]
+        chunker_apply = writer(opath_apply, schema=schema)
+        chunker_ipc = writer(opath_ipc, schema=schema_ipc)
 
     # parse it up
     try:
@@ -185,7 +237,7 @@ def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
         for pat in parser(fpath):
             i += 1
 
-            store_patent(pat, chunker_apply, chunker_ipc)
+            store(pat, chunker_apply, chunker_ipc, schema=schema)
 
             # output
             if display > 0 and i % display == 0:
@@ -197,28 +249,48 @@ def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
                 )
 
         # commit to db and close
-        chunker_apply.commit()
-        chunker_ipc.commit()
+        with metrics.timer('write'):
+            chunker_apply.commit()
+            chunker_ipc.commit()
+            chunker_apply.close()
+            chunker_ipc.close()
+
+        # record parser state for split files
+        if span is not None and not dryrun:
+            save_status(output, ftag, span, status)
 
         print(f'{ftag}: Parsed {i} patents')
+        if not dryrun:
+            metrics.save(output, ftag, i, gen=gen)
+            if span is None:
+                save_tag(output, fpath, version)
     except Exception as e:
         print(f'{ftag}: EXCEPTION OCCURRED!')
         print_exc()
 
         chunker_apply.delete()
         chunker_ipc.delete()
+        if not dryrun:
+            metrics.save(output, ftag, i, gen=gen, error=True)
+
+# source files (on disk or in zip archives)
+file_patterns = ['pab*.xml', 'ipab*.xml']
+
+# plan parsing of files (files larger than split bytes are parsed in parts), the tasks of
+# several sources can share a pool with run_jobs
+def plan_many(
+    files, output, display=1_000, overwrite=False, dryrun=False, split=256*2**20,
+    fields=None, text=True, format='csv'
+):
+    # check field selection up front
+    project_schema(schema_apply, fields=fields, text=text)
 
-# main entry point
-def parse_many(files, output, threads=10, display=1_000, overwrite=False, dryrun=False):
-    # needed for multiprocess
-    global parse_file_opts
+    # check output format up front
+    check_format(format)
 
     # collect files
     if type(files) is str or isinstance(files, os.PathLike):
-        file_list = (
-            sorted(glob.glob(f'{files}/pab*.xml')) +
-            sorted(glob.glob(f'{files}/ipab*.xml'))
-        )
+        file_list = find_files(files, file_patterns)
     else:
         file_list = files
 
@@ -227,10 +299,35 @@ def parse_many(files, output, threads=10, display=1_000, overwrite=False, dryrun
         print(f'Creating directory {output}')
         os.makedirs(output)
 
+    # skip current files and split large ones
+    version = lambda fpath: parse_version(fpath, fields=fields, text=text)
+    tasks, splits = plan_tasks(
+        file_list, output, output_tables, version, split=split, marker=split_marker,
+        overwrite=overwrite, dryrun=dryrun, format=format
+    )
+
     # apply options
-    def parse_file_opts(fpath):
-        parse_file(fpath, output, display=display, overwrite=overwrite, dryrun=dryrun)
+    def parse_file_opts(task):
+        fpath, span = task
+        parse_file(
+            fpath, output, display=display, overwrite=overwrite, dryrun=dryrun, span=span,
+            fields=fields, text=text, format=format
+        )
 
-    # parse files
-    with Pool(threads) as pool:
-        pool.map(parse_file_opts, file_list, chunksize=1)
+    return ParseJob(
+        parse_file_opts, output, output_tables, tasks, splits, version, dryrun=dryrun,
+        format=format
+    )
+
+# main entry point (tasks from all files are run largest first, see run_jobs for limits)
+def parse_many(
+    files, output, threads=10, max_tasks=None, max_rss=None, max_memory=None, **kwargs
+):
+    run_jobs(
+        [plan_many(files, output, **kwargs)], threads=threads, max_tasks=max_tasks,
+        max_rss=max_rss, max_memory=max_memory
+    )
+
+# fetch and parse in a pipeline
+def sync_many(urls, rawdir, output, **kwargs):
+    sync_pipeline(urls, rawdir, output, parse_file, file_patterns, **kwargs)
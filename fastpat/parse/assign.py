@@ -4,10 +4,34 @@ import glob
 from collections import defaultdict
 from traceback import print_exc
 from lxml.etree import iterparse
-from multiprocessing import Pool
 
 from ..tools.parse import *
-from ..tools.tables import ChunkWriter, DummyWriter
+from ..tools.tables import table_writers, check_format, DummyWriter
+from ..tools.metrics import ParseMetrics
+from ..tools.sync import sync_many as sync_pipeline
+
+# field paths
+fields_assign_gen3 = FieldExtractor(
+    scopes={
+        'record': 'assignment-record',
+        'assignor': 'patent-assignors/*',
+        'assignee': 'patent-assignees/*',
+    },
+    fields={
+        'reel': '$record/reel-no',
+        'frame': '$record/frame-no',
+        'conveyance': '$record/conveyance-text',
+        'assignor': '$assignor/name',
+        'assignee': '$assignee/name',
+        'execdate': '$assignor/execution-date/date',
+        'recdate': '$record/recorded-date/date',
+        'assignee_country': '$assignee/country-name',
+        'assignee_state': '$assignee/state',
+    },
+    defaults={
+        'assignee_country': 'united states',
+    },
+)
 
 # parse assignment
 def parse_assign_gen3(elem, fname):
@@ -15,41 +39,30 @@ def parse_assign_gen3(elem, fname):
     pat['gen'] = 3
     pat['file'] = fname
 
-    # top-level section
-    record = elem.find('assignment-record')
-    assignor = elem.find('patent-assignors')[0]
-    assignee = elem.find('patent-assignees')[0]
-    patents = elem.find('patent-properties')
+    # simple fields
+    pat.update(fields_assign_gen3(elem))
 
     # assign id = reel-no + frame-no
-    pat['bulkid'] = get_text(record, 'reel-no') + get_text(record, 'frame-no').zfill(3)
-
-    # conveyance
-    pat['conveyance'] = get_text(record, 'conveyance-text')
-
-    # names
-    pat['assignor'] = get_text(assignor, 'name')
-    pat['assignee'] = get_text(assignee, 'name')
-
-    # dates
-    pat['execdate'] = get_text(assignor, 'execution-date/date')
-    pat['recdate'] = get_text(record, 'recorded-date/date')
-
-    # location
-    pat['assignee_country'] = get_text(assignee, 'country-name', default='united states')
-    pat['assignee_state'] = get_text(assignee, 'state')
+    pat['bulkid'] = pat.pop('reel') + pat.pop('frame').zfill(3)
 
     # patent info
+    patents = elem.find('patent-properties')
     pat['patnums'] = [prune_patnum(pn) for pn in gen3_assign(patents)]
 
     return pat
 
-# parse file
-def parse_file_gen3(fpath):
+# parse file (spans are parsed as fragments)
+def parse_file_gen3(fpath, span=None, status=None, parser=parse_assign_gen3):
     _, fname = os.path.split(fpath)
-    for event, elem in iterparse(fpath, tag='patent-assignment', events=['end'], recover=True):
-        yield parse_assign_gen3(elem, fname)
-        clear(elem)
+    if span is not None:
+        yield from parse_wrapper(
+            fpath, 'patent-assignment', parser, span=span, status=status
+        )
+        return
+    with open_file(fpath) as fid:
+        for event, elem in iterparse(fid, tag='patent-assignment', events=['end'], recover=True):
+            yield parser(elem, fname)
+            clear(elem)
 
 # table schema
 schema_assign = {
@@ -82,32 +95,60 @@ def store_patent(pat, chunker_assign):
         pat['assignid'] = pat['bulkid'] + '_' + str(i)
         chunker_assign.insert(*(pat[k] for k in schema_assign))
 
-# file level
-def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
+# output tables
+output_tables = ['assign']
+
+# record boundaries for splitting files
+def split_marker(fpath):
+    return b'<patent-assignment>'
+
+# parser version, bump when a change alters the output so that files are re-parsed
+parser_version = 1
+
+# what outputs are tagged with (see is_current)
+def parse_version(fpath):
+    return {'parser': f'assign.v{parser_version}', 'columns': list(schema_assign)}
+
+# file level (span restricts to a byte range of the file), format is the output table format
+# (see table_writers)
+def parse_file(
+    fpath, output, display=0, overwrite=False, dryrun=False, span=None, format='csv'
+):
     fdir, fname = os.path.split(fpath)
     ftag, fext = os.path.splitext(fname)
 
-    opath_assign = os.path.join(output, f'assign_{ftag}.csv')
+    opath_assign = output_path(output, 'assign', ftag, span=span, format=format)
+
+    # parts of split files are checked when planned
+    version = parse_version(fpath)
+    if span is None and not overwrite and is_current(
+        output, output_tables, fpath, version, format=format
+    ):
+        print(f'{ftag}: Skipping')
+        return
+    if span is None and not dryrun:
+        drop_tag(output, fpath)
 
-    if not overwrite:
-        if os.path.exists(opath_assign):
-            print(f'{ftag}: Skipping')
-            return
+    metrics = ParseMetrics(fpath, span=span)
+    store = metrics.timed('write', store_patent)
 
     if dryrun:
         chunker_assign = DummyWriter()
     else:
-        chunker_assign = ChunkWriter(opath_assign, schema=schema_assign)
+        writer = table_writers[format]
+        chunker_assign = writer(opath_assign, schema=schema_assign)
 
     # parse it up
     try:
         print(f'{ftag}: Starting')
 
         i = 0
-        for pat in parse_file_gen3(fpath):
+        status = {}
+        extract = metrics.timed('extract', parse_assign_gen3)
+        for pat in parse_file_gen3(fpath, span=span, status=status, parser=extract):
             i += 1
 
-            store_patent(pat, chunker_assign)
+            store(pat, chunker_assign)
 
             # output
             if display > 0 and i % display == 0:
@@ -121,21 +162,41 @@ def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
         print(f'{ftag}: Parsed {i} records')
 
         # clear out the rest
-        chunker_assign.commit()
+        with metrics.timer('write'):
+            chunker_assign.commit()
+            chunker_assign.close()
+
+        # record parser state for split files
+        if span is not None and not dryrun:
+            save_status(output, ftag, span, status)
+
+        if not dryrun:
+            metrics.save(output, ftag, i, gen=3)
+            if span is None:
+                save_tag(output, fpath, version)
     except Exception as e:
         print(f'{ftag}: EXCEPTION OCCURRED!')
         print_exc()
 
         chunker_assign.delete()
+        if not dryrun:
+            metrics.save(output, ftag, i, gen=3, error=True)
+
+# source files (on disk or in zip archives)
+file_patterns = ['*.xml']
 
-# main entry point
-def parse_many(files, output, threads=10, display=1_000, overwrite=False, dryrun=False):
-    # needed for multiprocess
-    global parse_file_opts
+# plan parsing of files (files larger than split bytes are parsed in parts), the tasks of
+# several sources can share a pool with run_jobs
+def plan_many(
+    files, output, display=1_000, overwrite=False, dryrun=False, split=256*2**20,
+    format='csv'
+):
+    # check output format up front
+    check_format(format)
 
     # collect files
     if type(files) is str or isinstance(files, os.PathLike):
-        file_list = sorted(glob.glob(f'{files}/*.xml'))
+        file_list = find_files(files, file_patterns)
     else:
         file_list = files
 
@@ -144,10 +205,35 @@ def parse_many(files, output, threads=10, display=1_000, overwrite=False, dryrun
         print(f'Creating directory {output}')
         os.makedirs(output)
 
-    # apply options
-    def parse_file_opts(fpath):
-        parse_file(fpath, output, display=display, overwrite=overwrite, dryrun=dryrun)
+    # skip current files and split large ones
+    version = lambda fpath: parse_version(fpath)
+    tasks, splits = plan_tasks(
+        file_list, output, output_tables, version, split=split, marker=split_marker,
+        overwrite=overwrite, dryrun=dryrun, format=format
+    )
 
-    # parse files
-    with Pool(threads) as pool:
-        pool.map(parse_file_opts, file_list, chunksize=1)
+    # apply options
+    def parse_file_opts(task):
+        fpath, span = task
+        parse_file(
+            fpath, output, display=display, overwrite=overwrite, dryrun=dryrun, span=span,
+            format=format
+        )
+
+    return ParseJob(
+        parse_file_opts, output, output_tables, tasks, splits, version, dryrun=dryrun,
+        format=format
+    )
+
+# main entry point (tasks from all files are run largest first, see run_jobs for limits)
+def parse_many(
+    files, output, threads=10, max_tasks=None, max_rss=None, max_memory=None, **kwargs
+):
+    run_jobs(
+        [plan_many(files, output, **kwargs)], threads=threads, max_tasks=max_tasks,
+        max_rss=max_rss, max_memory=max_memory
+    )
+
+# fetch and parse in a pipeline
+def sync_many(urls, rawdir, output, **kwargs):
+    sync_pipeline(urls, rawdir, output, parse_file, file_patterns, **kwargs)
@@ -1,6 +1,9 @@
 import os
 import pandas as pd
 
+from ..tools.tables import table_formats, check_format, write_frame
+from ..tools.metrics import ParseMetrics
+
 colmap = {
     'row': 'row',
     'gvkey': 'gvkey',
@@ -32,15 +35,16 @@ dtype = {
     'sic': 'Int64'
 }
 
-def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
+def parse_file(fpath, output, display=0, overwrite=False, dryrun=False, format='csv'):
     fdir, fname = os.path.split(fpath)
-    opath = os.path.join(output, 'compustat_compustat.csv')
+    opath = os.path.join(output, f'compustat_compustat{table_formats[format]}')
 
     if not overwrite and os.path.exists(opath):
         print(f'{fname}: Skipping')
         return
     else:
         print(f'{fname}: Starting')
+    metrics = ParseMetrics(fpath)
 
     # read frame into memory
     datf = pd.read_csv(fpath, index_col=0, usecols=colmap, dtype=dtype)
@@ -59,10 +63,17 @@ def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
 
     # write to disk
     if not dryrun:
-        datf.to_csv(opath, index=False, float_format='%.3f')
+        with metrics.timer('write'):
+            write_frame(datf, opath, format=format, float_format='%.3f')
+        metrics.save(output, 'compustat', len(datf))
 
 # really this is only one file
-def parse_many(files, output, overwrite=False, dryrun=False, threads=None):
+def parse_many(
+    files, output, overwrite=False, dryrun=False, threads=None, split=None, format='csv'
+):
+    # check output format up front
+    check_format(format)
+
     if os.path.isdir(files):
         file_one = os.path.join(files, 'compustat.csv')
     else:
@@ -73,4 +84,4 @@ def parse_many(files, output, overwrite=False, dryrun=False, threads=None):
         print(f'Creating directory {output}')
         os.makedirs(output)
 
-    parse_file(file_one, output, overwrite=overwrite, dryrun=dryrun)
+    parse_file(file_one, output, overwrite=overwrite, dryrun=dryrun, format=format)
@@ -2,126 +2,185 @@ import re
 import os
 import glob
 from collections import defaultdict
+from functools import partial
 from traceback import print_exc
-from itertools import chain
-from multiprocessing import Pool
 
 from ..tools.parse import *
-from ..tools.tables import ChunkWriter, DummyWriter
-
-# parse it up
-def parse_grant_gen1(fname):
-    pat = None
-    sec = None
-    tag = None
-    ipcver = None
-    for nline in chain(open(fname, encoding='latin1', errors='ignore'), ['PATN']):
-        # peek at next line
-        ntag, nbuf = nline[:4].rstrip(), nline[5:-1].rstrip().lower()
-        if tag is None:
-            tag = ntag
-            buf = nbuf
-            continue
-        if ntag == '':
-            buf += nbuf
-            continue
-
-        # regular tags
-        if tag == 'PATN':
-            if pat is not None:
-                pat['appnum'] = src + apn
-                yield pat
-            pat = defaultdict(str)
-            sec = 'PATN'
-            pat['gen'] = 1
-            _, pat['file'] = os.path.split(fname)
-            pat['ipcs'] = []
-            pat['cites'] = []
-            src, apn = '', ''
-        elif tag in ['INVT', 'ASSG', 'PRIR', 'CLAS', 'UREF', 'FREF', 'OREF', 'LREP', 'PCTA', 'ABST']:
-            sec = tag
-        elif tag in ['PAL', 'PAR', 'PAC', 'PA0', 'PA1']:
-            if sec == 'ABST':
-                if 'abstract' not in pat:
-                    pat['abstract'] = buf
+from ..tools.tables import table_writers, check_format, DummyWriter
+from ..tools.metrics import ParseMetrics
+from ..tools.sync import sync_many as sync_pipeline
+
+# gen 1 section tags (other tags leave the section unchanged)
+sections_gen1 = {'PATN', 'INVT', 'ASSG', 'PRIR', 'CLAS', 'UREF', 'FREF', 'OREF', 'LREP', 'PCTA', 'ABST'}
+
+# gen 1 fields kept, by section and tag
+fields_gen1 = {
+    'PATN': {
+        'WKU': 'patnum',
+        'SRC': 'src',
+        'APN': 'apn',
+        'ISD': 'pubdate',
+        'APD': 'appdate',
+        'TTL': 'title',
+        'NCL': 'claims',
+    },
+    'ASSG': {
+        'NAM': 'owner',
+        'CTY': 'city',
+        'STA': 'state',
+        'CNT': 'country',
+    },
+    'CLAS': {
+        'ICL': 'ipcs',
+        'EDF': 'ipcver',
+    },
+    'UREF': {
+        'PNO': 'cites',
+    },
+    'ABST': {tag: 'abstract' for tag in ['PAL', 'PAR', 'PAC', 'PA0', 'PA1']},
+}
+
+# gen 1 records as bytes, each starting at a PATN line. a record is only complete once the
+# next PATN is seen, so the last one in a file is not returned
+def gen1_records(fpath):
+    data = map_file(fpath)
+    if data.find(b'\r') != -1:
+        data = data[:].replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    if data[:4] == b'PATN':
+        pos = 0
+    else:
+        pos = data.find(b'\nPATN')
+        if pos == -1:
+            return
+        pos += 1
+    while True:
+        end = data.find(b'\nPATN', pos)
+        if end == -1:
+            return
+        yield data[pos:end+1]
+        pos = end + 1
+
+# latin1 whitespace and lowercase as bytes operations (same as str rstrip and lower)
+space_latin1 = bytes(i for i in range(256) if chr(i).isspace())
+lower_latin1 = bytes(ord(chr(i).lower()) for i in range(256))
+
+def decode_latin1(buf):
+    return buf.translate(lower_latin1).decode('latin1')
+
+# parse gen 1 records, only kept fields are decoded (state is read when country is kept, as
+# a state implies a us assignee)
+def parse_grant_gen1(fpath, skip=()):
+    _, fname = os.path.split(fpath)
+    tags = {}
+    needed = lambda fd: fd not in skip or (fd == 'state' and 'country' not in skip)
+    sections = {
+        sec: {tag: fd for tag, fd in tab.items() if needed(fd)}
+        for sec, tab in fields_gen1.items()
+    }
+    for rec in gen1_records(fpath):
+        pat = defaultdict(str)
+        pat['gen'] = 1
+        pat['file'] = fname
+        pat['ipcs'] = []
+        pat['cites'] = []
+        src, apn = '', ''
+        abstract = []
+
+        # fields are a tag line followed by continuation lines
+        kept = sections['PATN']
+        field = None
+        lines = rec.split(b'\n')
+        lines[-1] = b'PATN'
+        for line in lines[1:]:
+            key = line[:4]
+            tag = tags.get(key)
+            if tag is None:
+                tag = tags[key] = key.decode('latin1').rstrip()
+            if tag == '':
+                if field is not None:
+                    parts.append(line[5:].rstrip(space_latin1))
+                continue
+
+            # store completed field (abstract lines go straight to their own list)
+            if field is not None and field != 'abstract':
+                buf = decode_latin1(b''.join(parts))
+                if field == 'patnum':
+                    pat['patnum'] = prune_patnum(buf)
+                elif field == 'src':
+                    src = '29' if buf == 'd' else buf.zfill(2) # design patents get series code 29
+                elif field == 'apn':
+                    apn = buf[:6]
+                elif field == 'ipcs':
+                    pat['ipcs'].append(pad_ipc(buf))
+                elif field == 'cites':
+                    pat['cites'].append(prune_patnum(buf))
+                elif field == 'state':
+                    pat['state'] = buf
+                    pat['country'] = 'us'
+                elif field == 'country':
+                    pat['country'] = buf[:2]
                 else:
-                    pat['abstract'] += '\n' + buf
-        elif tag == 'WKU':
-            if sec == 'PATN':
-                pat['patnum'] = prune_patnum(buf)
-        elif tag == 'SRC':
-            if sec == 'PATN':
-                src = '29' if buf == 'd' else buf.zfill(2) # design patents get series code 29
-        elif tag == 'APN':
-            if sec == 'PATN':
-                apn = buf[:6]
-        elif tag == 'ISD':
-            if sec == 'PATN':
-                pat['pubdate'] = buf
-        elif tag == 'APD':
-            if sec == 'PATN':
-                pat['appdate'] = buf
-        elif tag == 'ICL':
-            if sec == 'CLAS':
-                pat['ipcs'].append(pad_ipc(buf))
-        elif tag == 'EDF':
-            if sec == 'CLAS':
-                pat['ipcver'] = buf
-        elif tag == 'TTL':
-            if sec == 'PATN':
-                pat['title'] = buf
-        elif tag == 'NCL':
-            if sec == 'PATN':
-                pat['claims'] = buf
-        elif tag == 'NAM':
-            if sec == 'ASSG':
-                pat['owner'] = buf
-        elif tag == 'CTY':
-            if sec == 'ASSG':
-                pat['city'] = buf
-        elif tag == 'STA':
-            if sec == 'ASSG':
-                pat['state'] = buf
-                pat['country'] = 'us'
-        elif tag == 'CNT':
-            if sec == 'ASSG':
-                pat['country'] = buf[:2]
-        elif tag == 'PNO':
-            if sec == 'UREF':
-                pat['cites'].append(prune_patnum(buf))
-
-        # stage next tag and buf
-        tag = ntag
-        buf = nbuf
-
-def parse_grant_gen2(elem, fname):
+                    pat[field] = buf
+
+            # start next field
+            if tag in sections_gen1:
+                kept = sections.get(tag, {})
+            field = kept.get(tag)
+            if field == 'abstract':
+                if len(abstract) > 0:
+                    abstract.append(b'\n')
+                parts = abstract
+                parts.append(line[5:].rstrip(space_latin1))
+            elif field is not None:
+                parts = [line[5:].rstrip(space_latin1)]
+
+        if len(abstract) > 0:
+            pat['abstract'] = decode_latin1(b''.join(abstract))
+        pat['appnum'] = src + apn
+        yield pat
+
+# field paths (gen 2)
+fields_grant_gen2 = FieldExtractor(
+    scopes={
+        'bib': 'SDOBI',
+        'pubref': '$bib/B100',
+        'appref': '$bib/B200',
+        'patref': '$bib/B500',
+        'ipcsec': '$patref/B510',
+        'ownref': '$bib/B700/B730/B731/PARTY-US',
+        'address': '$ownref/ADR',
+    },
+    fields={
+        'patnum': '$pubref/B110/DNUM/PDAT',
+        'pubdate': '$pubref/B140/DATE/PDAT',
+        'appnum': '$appref/B210/DNUM/PDAT',
+        'appdate': '$appref/B220/DATE/PDAT',
+        'ipcver': '$ipcsec/B516/PDAT',
+        'title': '$patref/B540/STEXT/PDAT',
+        'claims': '$patref/B570/B577/PDAT',
+        'owner': '$ownref/NAM/ONM/STEXT/PDAT',
+        'city': '$address/CITY/PDAT',
+        'state': '$address/STATE/PDAT',
+        'country': '$address/CTRY/PDAT',
+    },
+)
+
+def parse_grant_gen2(elem, fname, skip=()):
     pat = defaultdict(str)
     pat['gen'] = 2
     pat['file'] = fname
 
-    # top-level section
-    bib = elem.find('SDOBI')
-
-    # published patent
-    pubref = bib.find('B100')
-    pat['patnum'] = prune_patnum(get_text(pubref, 'B110/DNUM/PDAT'))
-    pat['pubdate'] = get_text(pubref, 'B140/DATE/PDAT')
-
-    # filing date
-    appref = bib.find('B200')
-    pat['appnum'] = get_text(appref, 'B210/DNUM/PDAT')
-    pat['appdate'] = get_text(appref, 'B220/DATE/PDAT')
+    # simple fields
+    pat.update(fields_grant_gen2(elem, skip))
+    pat['patnum'] = prune_patnum(pat['patnum'])
 
     # reference info
-    patref = bib.find('B500')
+    patref = elem.find('SDOBI/B500')
     ipcsec = patref.find('B510')
     if ipcsec is not None:
-        pat['ipcver'] = get_text(ipcsec, 'B516/PDAT')
         pat['ipcs'] = [pad_ipc(ip) for ip in gen15_ipc(ipcsec)]
     else:
         pat['ipcs'] = []
-    pat['title'] = get_text(patref, 'B540/STEXT/PDAT')
-    pat['claims'] = get_text(patref, 'B570/B577/PDAT')
 
     # citations
     refs = patref.find('B560')
@@ -130,46 +189,51 @@ def parse_grant_gen2(elem, fname):
     else:
         pat['cites'] = []
 
-    # applicant name and address
-    ownref = bib.find('B700/B730/B731/PARTY-US')
-    if ownref is not None:
-        pat['owner'] = get_text(ownref, 'NAM/ONM/STEXT/PDAT')
-        address = ownref.find('ADR')
-        if address is not None:
-            pat['city'] = get_text(address, 'CITY/PDAT')
-            pat['state'] = get_text(address, 'STATE/PDAT')
-            pat['country'] = get_text(address, 'CTRY/PDAT')
-
     # abstract
-    abspars = elem.findall('SDOAB/BTEXT/PARA')
-    if len(abspars) > 0:
-        pat['abstract'] = '\n'.join([raw_text(e) for e in abspars])
+    if 'abstract' not in skip:
+        abspars = elem.findall('SDOAB/BTEXT/PARA')
+        if len(abspars) > 0:
+            pat['abstract'] = '\n'.join([raw_text(e) for e in abspars])
 
     # roll it in
     return pat
 
-def parse_grant_gen3(elem, fname):
+# field paths (gen 3)
+fields_grant_gen3 = FieldExtractor(
+    scopes={
+        'bib': 'us-bibliographic-data-grant',
+        'pubref': '$bib/publication-reference',
+        'pubinfo': '$pubref/document-id',
+        'appref': '$bib/application-reference',
+        'appinfo': '$appref/document-id',
+        'assignee': '$bib/assignees/assignee/addressbook',
+        'address': '$assignee/address',
+    },
+    fields={
+        'patnum': '$pubinfo/doc-number',
+        'pubdate': '$pubinfo/date',
+        'appnum': '$appinfo/doc-number',
+        'appdate': '$appinfo/date',
+        'title': '$bib/invention-title',
+        'claims': '$bib/number-of-claims',
+        'owner': '$assignee/orgname',
+        'city': '$address/city',
+        'state': '$address/state',
+        'country': '$address/country',
+    },
+)
+
+def parse_grant_gen3(elem, fname, skip=()):
     pat = defaultdict(str)
     pat['gen'] = 3
     pat['file'] = fname
 
+    # simple fields
+    pat.update(fields_grant_gen3(elem, skip))
+    pat['patnum'] = prune_patnum(pat['patnum'], maxlen=8)
+
     # top-level section
     bib = elem.find('us-bibliographic-data-grant')
-    pubref = bib.find('publication-reference')
-    appref = bib.find('application-reference')
-
-    # published patent
-    pubinfo = pubref.find('document-id')
-    pat['patnum'] = prune_patnum(get_text(pubinfo, 'doc-number'), maxlen=8)
-    pat['pubdate'] = get_text(pubinfo, 'date')
-
-    # filing date
-    appinfo = appref.find('document-id')
-    pat['appnum'] = get_text(appinfo, 'doc-number')
-    pat['appdate'] = get_text(appinfo, 'date')
-
-    # title
-    pat['title'] = get_text(bib, 'invention-title')
 
     # ipc code
     pat['ipcs'] = []
@@ -183,9 +247,6 @@ def parse_grant_gen3(elem, fname):
             pat['ipcver'] = get_text(ipcsec, 'classification-ipcr/ipc-version-indicator/date')
             pat['ipcs'] = [ip for ip in gen3r_ipc(ipcsec)]
 
-    # claims
-    pat['claims'] = get_text(bib, 'number-of-claims')
-
     # citations
     refs = bib.find('references-cited')
     prefix = ''
@@ -197,24 +258,18 @@ def parse_grant_gen3(elem, fname):
     else:
         pat['cites'] = []
 
-    # applicant name and address
-    assignee = bib.find('assignees/assignee/addressbook')
-    if assignee is not None:
-        pat['owner'] = get_text(assignee, 'orgname')
-        address = assignee.find('address')
-        if address is not None:
-            pat['city'] = get_text(address, 'city')
-            pat['state'] = get_text(address, 'state')
-            pat['country'] = get_text(address, 'country')
-
     # abstract
-    abspar = elem.find('abstract')
+    abspar = None if 'abstract' in skip else elem.find('abstract')
     if abspar is not None:
         pat['abstract'] = raw_text(abspar, sep=' ')
 
     # roll it in
     return pat
 
+# sections read by parse_grant_gen3 and bulky ones dropped unparsed (target engine)
+sections_grant_gen3 = ['us-bibliographic-data-grant', 'abstract']
+skip_grant_gen3 = ['description', 'claims', 'drawings', 'us-sequence-list-doc']
+
 # table schemas
 schema_grant = {
     'patnum': 'str', # Patent number
@@ -246,8 +301,11 @@ schema_cite = {
     'dst': 'str' # Destination patent (citee)
 }
 
-# patent adder
-def store_patent(pat, chunker_grant, chunker_ipc, chunker_cite):
+# fields other tables are keyed on
+required_grant = ['patnum', 'ipcver']
+
+# patent adder (schema is the projected grant schema)
+def store_patent(pat, chunker_grant, chunker_ipc, chunker_cite, schema=schema_grant):
     pn, iv = pat['patnum'], pat['ipcver']
 
     # store cites
@@ -261,44 +319,105 @@ def store_patent(pat, chunker_grant, chunker_ipc, chunker_cite):
         chunker_ipc.insert(pn, ipc, j, iv)
 
     # store patent
-    chunker_grant.insert(*(pat.get(k, '') for k in schema_grant))
+    chunker_grant.insert(*(pat.get(k, '') for k in schema))
+
+# output tables
+output_tables = ['grant', 'ipc', 'cite']
+
+# document boundaries for splitting files
+def split_marker(fpath):
+    if fpath.endswith('.xml'):
+        return b'<?xml'
 
-# file level
-def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
+# format generation of a source file
+def file_gen(fpath):
+    _, fname = os.path.split(fpath)
+    if fname.endswith('.dat'):
+        return 1
+    elif fname.startswith('pgb'):
+        return 2
+    elif fname.startswith('ipgb'):
+        return 3
+
+# parser version of each generation, bump one when a change alters its output and only files
+# of that generation are re-parsed
+parser_versions = {1: 2, 2: 1, 3: 1}
+
+# what outputs are tagged with (see is_current)
+def parse_version(fpath, fields=None, text=True):
+    schema, _ = project_schema(schema_grant, fields=fields, text=text)
+    gen = file_gen(fpath)
+    return {'parser': f'grant.gen{gen}.v{parser_versions.get(gen)}', 'columns': list(schema)}
+
+# gen 3 parse engines (see parse_file)
+engines = ['tree', 'target']
+
+def check_engine(engine):
+    if engine not in engines:
+        raise Exception(f'Unknown parse engine: {engine} (one of {", ".join(engines)})')
+
+# file level (span restricts to a byte range of the file)
+# engine='target' parses gen 3 files without building description and claims elements
+# fields selects the grant table columns (all if None), text=False drops the abstract
+# format is the output table format (see table_writers)
+def parse_file(
+    fpath, output, display=0, overwrite=False, dryrun=False, span=None, engine='tree',
+    fields=None, text=True, format='csv'
+):
+    check_engine(engine)
     fdir, fname = os.path.split(fpath)
     ftag, fext = os.path.splitext(fname)
+    schema, skip = project_schema(
+        schema_grant, fields=fields, text=text, required=required_grant
+    )
 
-    opath_grant = os.path.join(output, f'grant_{ftag}.csv')
-    opath_ipc = os.path.join(output, f'ipc_{ftag}.csv')
-    opath_cite = os.path.join(output, f'cite_{ftag}.csv')
+    opath_grant = output_path(output, 'grant', ftag, span=span, format=format)
+    opath_ipc = output_path(output, 'ipc', ftag, span=span, format=format)
+    opath_cite = output_path(output, 'cite', ftag, span=span, format=format)
 
-    complete = (
-        os.path.exists(opath_grant) and
-        os.path.exists(opath_ipc) and
-        os.path.exists(opath_cite)
-    )
-    if not overwrite and complete:
+    # parts of split files are checked when planned
+    version = parse_version(fpath, fields=fields, text=text)
+    if span is None and not overwrite and is_current(
+        output, output_tables, fpath, version, format=format
+    ):
         print(f'{ftag}: Skipping')
         return
+    if span is None and not dryrun:
+        drop_tag(output, fpath)
+
+    metrics = ParseMetrics(fpath, span=span)
+    store = metrics.timed('write', store_patent)
 
     if dryrun:
         chunker_grant = DummyWriter()
         chunker_ipc = DummyWriter()
         chunker_cite = DummyWriter()
     else:
-        chunker_grant = ChunkWriter(opath_grant, schema=schema_grant)
-        chunker_ipc = ChunkWriter(opath_ipc, schema=schema_ipc)
-        chunker_cite = ChunkWriter(opath_cite, schema=schema_cite)
-
-    if fname.endswith('.dat'):
-        gen = 1
-        parser = parse_grant_gen1
-    elif fname.startswith('pgb'):
-        gen = 2
-        parser = lambda fp: parse_wrapper(fp, 'PATDOC', parse_grant_gen2)
-    elif fname.startswith('ipgb'):
-        gen = 3
-        parser = lambda fp: parse_wrapper(fp, 'us-patent-grant', parse_grant_gen3)
+        writer = table_writers[format]
+        chunker_grant = writer(opath_grant, schema=schema)
+        chunker_ipc = writer(opath_ipc, schema=schema_ipc)
+        chunker_cite = writer(opath_cite, schema=schema_cite)
+
+    gen = file_gen(fpath)
+    status = {}
+    if gen == 1:
+        parser = lambda fp: parse_grant_gen1(fp, skip=skip)
+    elif gen == 2:
+        extract = metrics.timed('extract', partial(parse_grant_gen2, skip=skip))
+        parser = lambda fp: parse_wrapper(fp, 'PATDOC', extract, span=span, status=status)
+    elif gen == 3 and engine == 'target':
+        # skipped abstracts are parsed but not built (cutting them from the input could
+        # change the parser error state for the records that follow)
+        keep = [sec for sec in sections_grant_gen3 if sec not in skip]
+        extract = metrics.timed('extract', partial(parse_grant_gen3, skip=skip))
+        parser = lambda fp: parse_target(
+            fp, 'us-patent-grant', extract, keep, skip=skip_grant_gen3, span=span, status=status
+        )
+    elif gen == 3:
+        extract = metrics.timed('extract', partial(parse_grant_gen3, skip=skip))
+        parser = lambda fp: parse_wrapper(
+            fp, 'us-patent-grant', extract, span=span, status=status
+        )
     else:
         print(f'{ftag}: Unknown format')
 
@@ -311,7 +430,7 @@ def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
             i += 1
 
             # store all info
-            store_patent(pat, chunker_grant, chunker_ipc, chunker_cite)
+            store(pat, chunker_grant, chunker_ipc, chunker_cite, schema=schema)
 
             # output if needed
             if display > 0 and i % display == 0:
@@ -323,11 +442,23 @@ def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
                 )
 
         # commit remaining
-        chunker_grant.commit()
-        chunker_ipc.commit()
-        chunker_cite.commit()
+        with metrics.timer('write'):
+            chunker_grant.commit()
+            chunker_ipc.commit()
+            chunker_cite.commit()
+            chunker_grant.close()
+            chunker_ipc.close()
+            chunker_cite.close()
+
+        # record parser state for split files
+        if span is not None and not dryrun:
+            save_status(output, ftag, span, status)
 
         print(f'{ftag}: Parsed {i} patents')
+        if not dryrun:
+            metrics.save(output, ftag, i, gen=gen)
+            if span is None:
+                save_tag(output, fpath, version)
     except Exception as e:
         print(f'{ftag}: EXCEPTION OCCURRED!')
         print_exc()
@@ -335,31 +466,65 @@ def parse_file(fpath, output, display=0, overwrite=False, dryrun=False):
         chunker_grant.delete()
         chunker_ipc.delete()
         chunker_cite.delete()
+        if not dryrun:
+            metrics.save(output, ftag, i, gen=gen, error=True)
 
-# main entry point
-def parse_many(files, output, threads=10, display=1_000, overwrite=False, dryrun=False):
-    # needed for multiprocess
-    global parse_file_opts
+# source files (on disk or in zip archives)
+file_patterns = ['*.dat', 'pgb*.xml', 'ipgb*.xml']
+
+# plan parsing of files (files larger than split bytes are parsed in parts), the tasks of
+# several sources can share a pool with run_jobs
+def plan_many(
+    files, output, display=1_000, overwrite=False, dryrun=False, split=256*2**20,
+    engine='tree', fields=None, text=True, format='csv'
+):
+    # check field selection up front
+    project_schema(schema_grant, fields=fields, text=text)
+
+    # check output format and engine up front
+    check_format(format)
+    check_engine(engine)
 
     # collect files
     if type(files) is str or isinstance(files, os.PathLike):
-        file_list = (
-            sorted(glob.glob(f'{files}/*.dat')) +
-            sorted(glob.glob(f'{files}/pgb*.xml')) +
-            sorted(glob.glob(f'{files}/ipgb*.xml'))
-        )
+        file_list = find_files(files, file_patterns)
     else:
-        file_list = args.target
+        file_list = files
 
     # ensure output dir
     if not dryrun and not os.path.exists(output):
         print(f'Creating directory {output}')
         os.makedirs(output)
 
+    # skip current files and split large ones
+    version = lambda fpath: parse_version(fpath, fields=fields, text=text)
+    tasks, splits = plan_tasks(
+        file_list, output, output_tables, version, split=split, marker=split_marker,
+        overwrite=overwrite, dryrun=dryrun, format=format
+    )
+
     # apply options
-    def parse_file_opts(fpath):
-        parse_file(fpath, output, display=display, overwrite=overwrite, dryrun=dryrun)
+    def parse_file_opts(task):
+        fpath, span = task
+        parse_file(
+            fpath, output, display=display, overwrite=overwrite, dryrun=dryrun, span=span,
+            engine=engine, fields=fields, text=text, format=format
+        )
+
+    return ParseJob(
+        parse_file_opts, output, output_tables, tasks, splits, version, dryrun=dryrun,
+        format=format
+    )
+
+# main entry point (tasks from all files are run largest first, see run_jobs for limits)
+def parse_many(
+    files, output, threads=10, max_tasks=None, max_rss=None, max_memory=None, **kwargs
+):
+    run_jobs(
+        [plan_many(files, output, **kwargs)], threads=threads, max_tasks=max_tasks,
+        max_rss=max_rss, max_memory=max_memory
+    )
 
-    # parse files
-    with Pool(threads) as pool:
-        pool.map(parse_file_opts, file_list, chunksize=1)
+# fetch and parse in a pipeline
+def sync_many(urls, rawdir, output, **kwargs):
+    sync_pipeline(urls, rawdir, output, parse_file, file_patterns, **kwargs)
@@ -1,8 +1,11 @@
 import os
-import glob
 import numpy as np
 import pandas as pd
 
+from ..tools.parse import open_file, find_files
+from ..tools.tables import table_formats, check_format, write_frame
+from ..tools.metrics import ParseMetrics
+
 # maint file layout
 colspec = [(0, 13), (14, 22), (23, 24), (25, 33), (34, 42), (43, 51), (52, 56)]
 
@@ -13,21 +16,23 @@ m12 = ['M1553', 'M172', 'M175', 'M185', 'M2553', 'M275', 'M285']
 mmap = [(m, 4) for m in m4] + [(m, 8) for m in m8] + [(m, 12) for m in m12]
 codes = pd.DataFrame(mmap, columns=['code', 'lag']).set_index('code')
 
-def parse_file(fpath, output, overwrite=False, dryrun=False):
+def parse_file(fpath, output, overwrite=False, dryrun=False, format='csv'):
     fdir, fname = os.path.split(fpath)
-    opath = os.path.join(output, 'maint_maint.csv')
+    opath = os.path.join(output, f'maint_maint{table_formats[format]}')
 
     if not overwrite and os.path.exists(opath):
         print(f'{fname}: Skipping')
         return
     else:
         print(f'{fname}: Starting')
+    metrics = ParseMetrics(fpath)
 
     # import to dataframe
     print('Reading table')
-    datf = pd.read_fwf(
-        fpath, colspecs=colspec, usecols=[0, 2, 6], names=['patnum', 'is_small', 'event_code']
-    )
+    with open_file(fpath) as fid:
+        datf = pd.read_fwf(
+            fid, colspecs=colspec, usecols=[0, 2, 6], names=['patnum', 'is_small', 'event_code']
+        )
     datf['patnum'] = datf['patnum'].apply(lambda s: s.lstrip('0').lower())
 
     # clean up data
@@ -44,7 +49,9 @@ def parse_file(fpath, output, overwrite=False, dryrun=False):
     # write to disk
     print('Writing table')
     if not dryrun:
-        dpat.to_csv(opath, index=False)
+        with metrics.timer('write'):
+            write_frame(dpat, opath, format=format)
+        metrics.save(output, 'maint', len(dpat))
 
 def get_date(fpath):
     fdir, fname = os.path.split(fpath)
@@ -52,11 +59,19 @@ def get_date(fpath):
     _, date = fbase.split('_')
     return int(date)
 
+# source files (on disk or in zip archives)
+file_patterns = ['MaintFeeEvents_*.txt']
+
 # really this is only one file
-def parse_many(files, output, overwrite=False, dryrun=False, threads=None):
+def parse_many(
+    files, output, overwrite=False, dryrun=False, threads=None, split=None, format='csv'
+):
+    # check output format up front
+    check_format(format)
+
     if os.path.isdir(files):
         # get latest file
-        maint_files = glob.glob(f'{files}/MaintFeeEvents_*.txt')
+        maint_files = find_files(files, file_patterns)
         dates = [get_date(fp) for fp in maint_files]
         max_index = np.argmax(dates)
         file_one = maint_files[max_index]
@@ -68,4 +83,4 @@ def parse_many(files, output, overwrite=False, dryrun=False, threads=None):
         print(f'Creating directory {output}')
         os.makedirs(output)
 
-    parse_file(file_one, output, overwrite=overwrite, dryrun=dryrun)
+    parse_file(file_one, output, overwrite=overwrite, dryrun=dryrun, format=format)
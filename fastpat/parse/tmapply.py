@@ -3,32 +3,43 @@ import os
 import glob
 from collections import defaultdict
 from traceback import print_exc
-from multiprocessing import Pool
 from lxml.etree import iterparse
 
 from ..tools.parse import *
-from ..tools.tables import ChunkWriter, DummyWriter
+from ..tools.tables import table_writers, check_format, DummyWriter
+from ..tools.metrics import ParseMetrics
+from ..tools.sync import sync_many as sync_pipeline
+
+# field paths
+fields_tmapply = FieldExtractor(
+    scopes={
+        'head': 'case-file-header',
+    },
+    fields={
+        'serial': 'serial-number',
+        'regdate': '$head/registration-date',
+        'filedate': '$head/filing-date',
+    },
+)
+
+fields_statement = FieldExtractor({
+    'code': 'type-code',
+    'text': 'text',
+})
 
 def parse_tmapply(elem, fname):
     tma = defaultdict(str)
     tma['file'] = fname
 
-    # top-level section
-    tma['serial'] = get_text(elem, 'serial-number')
-
-    # header information
-    head = elem.find('case-file-header')
-    if head is not None:
-        tma['regdate'] = get_text(head, 'registration-date')
-        tma['filedate'] = get_text(head, 'filing-date')
+    # simple fields
+    tma.update(fields_tmapply(elem))
 
     # case file statements
     stats = []
     for st in elem.findall('case-file-statements/case-file-statement'):
-        tc = get_text(st, 'type-code')
-        if tc.startswith('gs'):
-            tx = get_text(st, 'text')
-            stats.append((tc, tx))
+        st = fields_statement(st)
+        if st['code'].startswith('gs'):
+            stats.append((st['code'], st['text']))
 
     # summarize
     tma['n_stat'] = len(stats)
@@ -73,34 +84,72 @@ schema_tmapply = {
     'file': 'str', # path to source file
 }
 
-# file level
-def parse_file(fpath, output, overwrite=False, dryrun=False, display=0):
+# parse file (spans are parsed as fragments)
+def parse_file_gen(fpath, span=None, status=None, parser=parse_tmapply):
+    _, fname = os.path.split(fpath)
+    if span is not None:
+        yield from parse_wrapper(fpath, 'case-file', parser, span=span, status=status)
+        return
+    with open_file(fpath) as fid:
+        for event, elem in iterparse(fid, tag='case-file', events=['end'], recover=True):
+            yield parser(elem, fname)
+            clear(elem)
+
+# output tables
+output_tables = ['tmapply']
+
+# record boundaries for splitting files
+def split_marker(fpath):
+    return b'<case-file>'
+
+# parser version, bump when a change alters the output so that files are re-parsed
+parser_version = 1
+
+# what outputs are tagged with (see is_current)
+def parse_version(fpath):
+    return {'parser': f'tmapply.v{parser_version}', 'columns': list(schema_tmapply)}
+
+# file level (span restricts to a byte range of the file), format is the output table format
+# (see table_writers)
+def parse_file(
+    fpath, output, overwrite=False, dryrun=False, display=0, span=None, format='csv'
+):
     fdir, fname = os.path.split(fpath)
     ftag, fext = os.path.splitext(fname)
 
-    opath_tmapply = os.path.join(output, f'tmapply_{ftag}.csv')
+    opath_tmapply = output_path(output, 'tmapply', ftag, span=span, format=format)
 
-    if not overwrite and os.path.exists(opath_tmapply):
+    # parts of split files are checked when planned
+    version = parse_version(fpath)
+    if span is None and not overwrite and is_current(
+        output, output_tables, fpath, version, format=format
+    ):
         print(f'{ftag}: Skipping')
         return
+    if span is None and not dryrun:
+        drop_tag(output, fpath)
+
+    metrics = ParseMetrics(fpath, span=span)
+    store = metrics.timed('write', store_tmapply)
 
     if dryrun:
         chunker_tma = DummyWriter()
     else:
-        chunker_tma = ChunkWriter(opath_tmapply, schema=schema_tmapply)
+        writer = table_writers[format]
+        chunker_tma = writer(opath_tmapply, schema=schema_tmapply)
 
     # parse it up
     try:
         print(f'{ftag}: Starting')
 
         i = 0
-        for event, elem in iterparse(fpath, tag='case-file', events=['end'], recover=True):
+        status = {}
+        extract = metrics.timed('extract', parse_tmapply)
+        for tma in parse_file_gen(fpath, span=span, status=status, parser=extract):
             i += 1
 
-            # parse and store
-            tma = parse_tmapply(elem, fname)
-            store_tmapply(tma, chunker_tma)
-            clear(elem)
+            # store info
+            store(tma, chunker_tma)
 
             # output
             if display > 0 and i % display == 0:
@@ -112,23 +161,42 @@ def parse_file(fpath, output, overwrite=False, dryrun=False, display=0):
                 )
 
         # commit to db and close
-        chunker_tma.commit()
+        with metrics.timer('write'):
+            chunker_tma.commit()
+            chunker_tma.close()
+
+        # record parser state for split files
+        if span is not None and not dryrun:
+            save_status(output, ftag, span, status)
 
         print(f'{ftag}: Parsed {i} trademarks')
+        if not dryrun:
+            metrics.save(output, ftag, i)
+            if span is None:
+                save_tag(output, fpath, version)
     except Exception as e:
         print(f'{ftag}: EXCEPTION OCCURRED!')
         print_exc()
 
         chunker_tma.delete()
+        if not dryrun:
+            metrics.save(output, ftag, i, error=True)
 
-# main entry point
-def parse_many(files, output, threads=10, display=1_000, overwrite=False, dryrun=False):
-    # needed for multiprocess
-    global parse_file_opts
+# source files (on disk or in zip archives)
+file_patterns = ['apc*.xml']
+
+# plan parsing of files (files larger than split bytes are parsed in parts), the tasks of
+# several sources can share a pool with run_jobs
+def plan_many(
+    files, output, display=1_000, overwrite=False, dryrun=False, split=256*2**20,
+    format='csv'
+):
+    # check output format up front
+    check_format(format)
 
     # collect files
     if type(files) is str or isinstance(files, os.PathLike):
-        file_list = sorted(glob.glob(f'{files}/apc*.xml'))
+        file_list = find_files(files, file_patterns)
     else:
         file_list = files
 
@@ -137,10 +205,35 @@ def parse_many(files, output, threads=10, display=1_000, overwrite=False, dryrun
         print(f'Creating directory {output}')
         os.makedirs(output)
 
-    # apply options
-    def parse_file_opts(fpath):
-        parse_file(fpath, output, display=display, overwrite=overwrite, dryrun=dryrun)
+    # skip current files and split large ones
+    version = lambda fpath: parse_version(fpath)
+    tasks, splits = plan_tasks(
+        file_list, output, output_tables, version, split=split, marker=split_marker,
+        overwrite=overwrite, dryrun=dryrun, format=format
+    )
 
-    # parse files
-    with Pool(threads) as pool:
-        pool.map(parse_file_opts, file_list, chunksize=1)
+    # apply options
+    def parse_file_opts(task):
+        fpath, span = task
+        parse_file(
+            fpath, output, display=display, overwrite=overwrite, dryrun=dryrun, span=span,
+            format=format
+        )
+
+    return ParseJob(
+        parse_file_opts, output, output_tables, tasks, splits, version, dryrun=dryrun,
+        format=format
+    )
+
+# main entry point (tasks from all files are run largest first, see run_jobs for limits)
+def parse_many(
+    files, output, threads=10, max_tasks=None, max_rss=None, max_memory=None, **kwargs
+):
+    run_jobs(
+        [plan_many(files, output, **kwargs)], threads=threads, max_tasks=max_tasks,
+        max_rss=max_rss, max_memory=max_memory
+    )
+
+# fetch and parse in a pipeline
+def sync_many(urls, rawdir, output, **kwargs):
+    sync_pipeline(urls, rawdir, output, parse_file, file_patterns, **kwargs)
@@ -2,6 +2,9 @@ import os
 import glob
 import argparse
 from itertools import chain
+from multiprocessing import Pool
+
+from .tables import table_formats, manifest_ext, check_format, join_tables, save_manifest
 
 tables = {
     'grant': ['grant', 'ipc', 'cite'],
@@ -12,27 +15,75 @@ tables = {
     'compustat': ['compustat'],
 }
 
-def concat_files(input, output, case, table, dryrun=False):
-    system = print if dryrun else os.system
+# primary keys of main tables (duplicates can be dropped when concatenating)
+table_keys = {
+    'grant': 'patnum',
+    'apply': 'appnum',
+    'assign': 'assignid',
+}
 
-    fout = f'{output}/{case}_{table}.csv'
-    files = sorted(glob.glob(f'{input}/{table}_*.csv'))
+# stream the parsed files of a table into one through a temp file, so the output is either
+# complete or untouched. with dedup, only the first row for each primary key is kept. with
+# virtual, the files are only listed in a manifest that is read as the table (either one
+# replaces the other)
+def concat_files(
+    input, output, case, table, format='csv', dedup=False, virtual=False, dryrun=False
+):
+    ext = table_formats[format]
+    fout = f'{output}/{case}_{table}{ext}'
+    mout = f'{output}/{case}_{table}{manifest_ext}'
+    files = sorted(glob.glob(f'{input}/{table}_*{ext}'))
 
     if len(files) == 0:
         print(f'Table "{case}/{table}" not found')
         return
 
-    first = files[0]
-    flist = ' '.join(files)
+    key = table_keys.get(table) if dedup else None
+    if dryrun:
+        print(f'{case}/{table}: {len(files)} files -> {mout if virtual else fout}')
+        return
 
-    system(f'head -n 1 {first} > {fout}')
-    system(f'tail -q -n +2 {flist} >> {fout}')
+    if virtual:
+        save_manifest(files, mout, format=format)
+        if os.path.exists(fout):
+            os.remove(fout)
+        print(f'{case}/{table}: Listed {len(files)} files')
+        return
 
-def concat_tables(input, output, ftype, dryrun=False):
+    tpath = f'{fout}.tmp'
+    try:
+        dropped = join_tables(files, tpath, format=format, key=key)
+    except Exception:
+        if os.path.exists(tpath):
+            os.remove(tpath)
+        raise
+    os.replace(tpath, fout)
+    if os.path.exists(mout):
+        os.remove(mout)
+
+    if key is not None:
+        print(f'{case}/{table}: Dropped {dropped} duplicate rows by {key}')
+
+# the tables of a source are concatenated in parallel (one process each by default)
+def concat_tables(
+    input, output, ftype, format='csv', dedup=False, virtual=False, threads=None, dryrun=False
+):
+    check_format(format)
+    if dedup and virtual:
+        raise Exception('Virtual tables cannot be deduplicated')
     if not dryrun and not os.path.exists(output):
         print(f'Creating directory {output}')
         os.makedirs(output)
 
-    for tab in tables[ftype]:
+    tabs = tables[ftype]
+    for tab in tabs:
         print(f'Concat: {ftype}/{tab}')
-        concat_files(input, output, ftype, tab, dryrun=dryrun)
+
+    args = [(input, output, ftype, tab, format, dedup, virtual, dryrun) for tab in tabs]
+    threads = len(tabs) if threads is None else min(threads, len(tabs))
+    if threads > 1:
+        with Pool(threads) as pool:
+            pool.starmap(concat_files, args)
+    else:
+        for arg in args:
+            concat_files(*arg)
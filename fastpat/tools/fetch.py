@@ -1,36 +1,296 @@
 import os
+import json
 import time
-from urllib.request import urlretrieve
-from zipfile import ZipFile
+import hashlib
+import threading
+from email.utils import formatdate
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from queue import Queue, Empty, Full
+from traceback import print_exc
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, is_zipfile
 
-def fetch_file(zurl, output, overwrite=False, dryrun=False, unzip=False):
-    system = print if dryrun else os.system
+# token bucket (rate in requests per second, burst in requests)
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
 
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now-self.stamp)*self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens)/self.rate
+            time.sleep(wait)
+
+# one token bucket per host
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, burst=self.burst)
+            bucket = self.buckets[host]
+        bucket.acquire()
+
+# record of fetched files (size, hash, validators)
+class Manifest:
+    def __init__(self, path, dryrun=False):
+        self.path = path
+        self.dryrun = dryrun
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as fid:
+                self.entries = json.load(fid)
+        else:
+            self.entries = {}
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def update(self, name, info):
+        with self.lock:
+            if info is None:
+                self.entries.pop(name, None)
+            else:
+                self.entries[name] = info
+            self.save()
+
+    def save(self):
+        if self.dryrun:
+            return
+        tpath = f'{self.path}.tmp'
+        with open(tpath, 'w') as fid:
+            json.dump(self.entries, fid, indent=1, sort_keys=True)
+        os.replace(tpath, self.path)
+
+# hash existing file contents
+def hash_file(fpath, chunk_size=1<<20):
+    sha = hashlib.sha256()
+    with open(fpath, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha
+
+# resumable download into a .part file, returns None if not modified
+def download(zurl, zpath, manifest=None, check=None, chunk_size=1<<20):
+    _, zname = os.path.split(zurl)
+    ppath = f'{zpath}.part'
+    pname = f'{zname}.part'
+
+    # resume only if we know what the partial file holds
+    partial = manifest.get(pname) if manifest is not None else None
+    offset = os.path.getsize(ppath) if (partial is not None and os.path.exists(ppath)) else 0
+
+    headers = {}
+    if offset > 0:
+        headers['Range'] = f'bytes={offset}-'
+        if partial.get('etag') or partial.get('last_modified'):
+            headers['If-Range'] = partial.get('etag') or partial.get('last_modified')
+    elif check is not None:
+        if check.get('etag'):
+            headers['If-None-Match'] = check['etag']
+        if check.get('last_modified'):
+            headers['If-Modified-Since'] = check['last_modified']
+
+    try:
+        resp = urlopen(Request(zurl, headers=headers))
+    except HTTPError as e:
+        if e.code == 304:
+            return
+        elif e.code == 416 and offset > 0:
+            # stale partial file, start over
+            os.remove(ppath)
+            manifest.update(pname, None)
+            return download(zurl, zpath, manifest=manifest, check=check, chunk_size=chunk_size)
+        raise
+
+    with resp:
+        etag = resp.headers.get('ETag')
+        modified = resp.headers.get('Last-Modified')
+
+        if resp.status == 206:
+            print(f'Resuming {zname} at {offset} bytes')
+            sha = hash_file(ppath, chunk_size=chunk_size)
+            mode = 'ab'
+        else:
+            offset = 0
+            sha = hashlib.sha256()
+            mode = 'wb'
+
+        # full size, from the total of Content-Range or else Content-Length
+        total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+        length = resp.headers.get('Content-Length')
+        if resp.status == 206 and total.isdigit():
+            expected = int(total)
+        elif length is not None and length.isdigit():
+            expected = offset + int(length)
+        else:
+            expected = None
+
+        if manifest is not None:
+            manifest.update(pname, {'url': zurl, 'etag': etag, 'last_modified': modified})
+
+        size = offset
+        with open(ppath, mode) as fid:
+            for chunk in iter(lambda: resp.read(chunk_size), b''):
+                fid.write(chunk)
+                sha.update(chunk)
+                size += len(chunk)
+
+    # connection closed early, keep the partial file to resume from
+    if expected is not None and size != expected:
+        raise Exception(f'Incomplete download of {zname}: got {size} of {expected} bytes')
+
+    # atomically move into place
+    os.replace(ppath, zpath)
+    if manifest is not None:
+        manifest.update(pname, None)
+
+    return {
+        'url': zurl,
+        'size': size,
+        'sha256': sha.hexdigest(),
+        'etag': etag,
+        'last_modified': modified,
+    }
+
+# returns number of bytes fetched (None if skipped), raises if the download fails
+def fetch_file(
+    zurl, output, overwrite=False, dryrun=False, unzip=False, revalidate=False,
+    limiter=None, manifest=None
+):
     if not dryrun and not os.path.exists(output):
         print(f'Creating directory {output}')
         os.makedirs(output)
 
     _, zname = os.path.split(zurl)
     zpath = os.path.join(output, zname)
-    fetch = overwrite or not os.path.isfile(zpath)
+    entry = manifest.get(zname) if manifest is not None else None
 
-    if fetch:
-        print(f'Fetching {zname}')
-        try:
-            urlretrieve(zurl, zpath)
-        except:
-            print(f'Failed to fetch {zurl}')
-            return True
+    # refetch missing or truncated files
+    if overwrite or not os.path.isfile(zpath):
+        fetch = True
+    elif entry is not None:
+        fetch = os.path.getsize(zpath) != entry['size']
+    else:
+        fetch = not is_zipfile(zpath)
 
-    if fetch or unzip:
+    # conditional request for existing files
+    check = None
+    if not fetch and revalidate:
+        if entry is not None:
+            check = entry
+        else:
+            check = {'last_modified': formatdate(os.path.getmtime(zpath), usegmt=True)}
+
+    if fetch or check is not None:
+        if limiter is not None:
+            limiter.acquire(zurl)
+        print(f'Fetching {zname}' if fetch else f'Revalidating {zname}')
+        info = download(zurl, zpath, manifest=manifest, check=check)
+        if info is None:
+            print(f'Not modified {zname}')
+        else:
+            fetch = True
+            if manifest is not None:
+                manifest.update(zname, info)
+
+    # parsers read zip archives directly, so this is optional
+    if unzip:
         print(f'Unzipping {zname}')
         with ZipFile(zpath, 'r') as zfile:
             zfile.extractall(output)
 
-    return fetch
+    if fetch:
+        return os.path.getsize(zpath)
+
+# fetch concurrently, rate limited per host, yielding (path, size) as files complete
+# when queue is given, downloads pause while that many completed files are unconsumed
+# urls that fail are yielded with size None and appended to failed (if given)
+def fetch_iter(
+    files, output, threads=4, rate=0.2, burst=None, queue=None, dryrun=False, failed=None,
+    **kwargs
+):
+    if not dryrun and not os.path.exists(output):
+        print(f'Creating directory {output}')
+        os.makedirs(output)
+
+    files = list(files)
+    burst = threads if burst is None else burst
+    limiter = RateLimiter(rate, burst=burst)
+    manifest = Manifest(os.path.join(output, 'manifest.json'), dryrun=dryrun)
+    done = Queue(maxsize=0 if queue is None else queue)
+    stop = threading.Event()
+
+    # workers give up once the consumer has stopped, rather than block on a full queue
+    def fetch_one(zurl):
+        if stop.is_set():
+            return
+        _, zname = os.path.split(zurl)
+        zpath = os.path.join(output, zname)
+        try:
+            size = fetch_file(
+                zurl, output, dryrun=dryrun, limiter=limiter, manifest=manifest, **kwargs
+            )
+        except Exception:
+            print(f'Failed to fetch {zurl}')
+            print_exc()
+            size = None
+            if failed is not None:
+                failed.append(zurl)
+        while not stop.is_set():
+            try:
+                done.put((zpath, size), timeout=0.1)
+                return
+            except Full:
+                pass
+
+    pool = ThreadPoolExecutor(threads)
+    try:
+        for zurl in files:
+            pool.submit(fetch_one, zurl)
+        for _ in files:
+            yield done.get()
+    finally:
+        stop.set()
+        while True:
+            try:
+                done.get_nowait()
+            except Empty:
+                break
+        pool.shutdown(wait=True, cancel_futures=True)
+
+# fetch concurrently and report throughput
+def fetch_many(files, output, dryrun=False, **kwargs):
+    nfile, nbyte = 0, 0
+    failed = []
+    start = time.monotonic()
+
+    for zpath, size in fetch_iter(files, output, dryrun=dryrun, failed=failed, **kwargs):
+        if size is not None:
+            nfile += 1
+            nbyte += size
 
-def fetch_many(files, output, delay=10, dryrun=False, **kwargs):
-    for zurl in files:
-        fetch = fetch_file(zurl, output, dryrun=dryrun, **kwargs)
-        if fetch and not dryrun:
-            time.sleep(delay)
+    elapsed = time.monotonic() - start
+    mbyte = nbyte/1e6
+    print(f'Fetched {nfile} files ({mbyte:.1f} MB) in {elapsed:.1f}s ({mbyte/max(elapsed, 1e-9):.2f} MB/s)')
+    if len(failed) > 0:
+        raise Exception(f'Failed to fetch {len(failed)} files: {", ".join(failed)}')
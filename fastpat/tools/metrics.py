@@ -0,0 +1,121 @@
+# per-file parse metrics
+
+import os
+import json
+import glob
+import time
+import pandas as pd
+
+from .parse import task_size
+from .workers import get_peak
+
+# installed version, to compare runs across releases
+def get_version():
+    try:
+        from importlib.metadata import version
+        return version('fastpat')
+    except Exception:
+        return 'dev'
+
+fastpat_version = get_version()
+
+# time spent in a stage (adds to total on exit)
+class StageTimer:
+    def __init__(self, times, stage):
+        self.times = times
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.times[self.stage] += time.perf_counter() - self.start
+
+# metrics for parsing one file (or part). time in record extraction and csv writing is tracked
+# explicitly, the rest of the wall time is xml parsing (for gen 1 grants, where tokenizing and
+# extraction are one loop, all of it)
+class ParseMetrics:
+    def __init__(self, fpath, span=None):
+        self.fpath = fpath
+        self.span = span
+        self.times = {'extract': 0.0, 'write': 0.0}
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def timer(self, stage):
+        return StageTimer(self.times, stage)
+
+    # wrap a function to count its time towards stage
+    def timed(self, stage, func):
+        times = self.times
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times[stage] += time.perf_counter() - start
+        return wrapper
+
+    def finish(self, records, gen=None, error=False):
+        wall = time.perf_counter() - self.start
+        size = task_size((self.fpath, self.span))
+        return {
+            'file': os.path.basename(self.fpath),
+            'part': None if self.span is None else self.span[0],
+            'gen': gen,
+            'error': error,
+            'records': records,
+            'bytes': size,
+            'wall': round(wall, 4),
+            'cpu': round(time.process_time() - self.cpu, 4),
+            'parse': round(wall - sum(self.times.values()), 4),
+            'extract': round(self.times['extract'], 4),
+            'write': round(self.times['write'], 4),
+            'docs_sec': round(records / wall, 1) if wall > 0 else None,
+            'mb_sec': round(size / 2**20 / wall, 3) if wall > 0 else None,
+            'peak_rss': get_peak(),
+            'version': fastpat_version,
+            'stamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+
+    # append to output/_metrics/ftag.jsonl (one line per run of a file or part)
+    def save(self, output, ftag, records, gen=None, error=False):
+        mdir = os.path.join(output, '_metrics')
+        os.makedirs(mdir, exist_ok=True)
+        line = json.dumps(self.finish(records, gen=gen, error=error)) + '\n'
+        with open(os.path.join(mdir, f'{ftag}.jsonl'), 'a') as fid:
+            fid.write(line)
+
+# all metrics under a parsed directory
+def load_metrics(pardir):
+    rows = []
+    for mpath in sorted(glob.glob(os.path.join(pardir, '_metrics', '*.jsonl'))):
+        with open(mpath) as fid:
+            rows += [json.loads(line) for line in fid if len(line.strip()) > 0]
+    return pd.DataFrame(rows)
+
+# throughput and time split by generation and version, plus the slowest files (only the
+# latest run of each file or part counts)
+def summarize_metrics(frame, slowest=5):
+    frame = frame.sort_values('stamp', kind='stable')
+    frame = frame.drop_duplicates(['file', 'part', 'version'], keep='last')
+    frame = frame.assign(
+        gen=frame['gen'].fillna(0).astype(int), part=frame['part'].astype('Int64')
+    )
+    group = frame.groupby(['version', 'gen'])
+    summ = pd.DataFrame({
+        'files': group['file'].nunique(),
+        'errors': group['error'].sum(),
+        'records': group['records'].sum(),
+        'mb': group['bytes'].sum() / 2**20,
+        'wall': group['wall'].sum(),
+        'peak_mb': group['peak_rss'].max() / 2**20,
+    })
+    summ['docs_sec'] = summ['records'] / summ['wall']
+    summ['mb_sec'] = summ['mb'] / summ['wall']
+    for stage in ['parse', 'extract', 'write']:
+        summ[f'{stage}_pct'] = 100 * group[stage].sum() / summ['wall']
+
+    slow = frame.sort_values('mb_sec').head(slowest)
+    slow = slow[['file', 'part', 'gen', 'records', 'wall', 'docs_sec', 'mb_sec', 'version']]
+    return summ.round(2), slow
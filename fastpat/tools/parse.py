@@ -2,16 +2,434 @@
 ## common parsing tools
 ##
 
+import io
 import os
 import re
+import glob
+import json
+import mmap
+import time
+import shutil
+import hashlib
 import numpy as np
 import pandas as pd
-from lxml.etree import XMLPullParser
+from fnmatch import fnmatch
+from zipfile import ZipFile, BadZipFile
+from lxml.etree import XMLParser, XMLPullParser, TreeBuilder, XPath
+
+from .tables import table_formats, join_tables
+from .workers import WorkerPool
+
+##
+## file handling
+##
+
+# zip members are addressed as paths inside the archive (dir/archive.zip/member.xml)
+def split_zip(fpath):
+    fpath = str(fpath)
+    zpath, sep, member = fpath.partition('.zip' + os.sep)
+    if len(sep) == 0:
+        return fpath, None
+    else:
+        return zpath + '.zip', member
+
+# read-only view of a byte range of a file
+class FileRange(io.RawIOBase):
+    def __init__(self, fpath, start, stop):
+        self.fid = open(fpath, 'rb')
+        self.fid.seek(start)
+        self.left = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self.fid.read(min(len(buf), self.left))
+        buf[:len(data)] = data
+        self.left -= len(data)
+        return len(data)
+
+    def close(self):
+        self.fid.close()
+        super().close()
+
+# open file or zip member, binary unless encoding is given
+# span = (part, start, stop, primed, source) restricts to a byte range of source, which is
+# the file itself or an extracted copy of a zip member
+def open_file(fpath, encoding=None, errors='ignore', span=None):
+    zpath, member = split_zip(fpath)
+    if span is not None:
+        _, start, stop, _, source = span
+        fid = io.BufferedReader(FileRange(source, start, stop), buffer_size=1<<20)
+    elif member is None:
+        fid = open(zpath, 'rb')
+    else:
+        with ZipFile(zpath) as zfile:
+            fid = zfile.open(member)
+    if encoding is None:
+        return fid
+    else:
+        return io.TextIOWrapper(fid, encoding=encoding, errors=errors)
+
+# whole file as bytes, memory mapped unless it is a zip member
+def map_file(fpath):
+    zpath, member = split_zip(fpath)
+    if member is not None:
+        with open_file(fpath) as fid:
+            return fid.read()
+    with open(zpath, 'rb') as fid:
+        if os.fstat(fid.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+
+# list zip members as paths
+def zip_members(zpath):
+    try:
+        with ZipFile(zpath) as zfile:
+            names = zfile.namelist()
+    except BadZipFile:
+        print(f'{zpath}: Bad zip file')
+        return []
+    return [os.path.join(zpath, m) for m in names if not m.endswith('/')]
+
+# find files matching patterns on disk or in zip archives (extracted files take precedence)
+def find_files(path, patterns):
+    members = [
+        m for zpath in sorted(glob.glob(os.path.join(path, '*.zip'))) for m in zip_members(zpath)
+    ]
+
+    files = {}
+    for pat in patterns:
+        plain = glob.glob(os.path.join(path, pat))
+        zipped = [m for m in members if fnmatch(os.path.basename(m), pat)]
+        for fpath in sorted(plain + zipped, key=os.path.basename):
+            files.setdefault(os.path.basename(fpath), fpath)
+
+    return list(files.values())
+
+# file tag used to name outputs
+def file_tag(fpath):
+    _, fname = os.path.split(fpath)
+    ftag, _ = os.path.splitext(fname)
+    return ftag
+
+##
+## split files
+##
+
+# byte offsets of each occurrence of marker (documents or records)
+def index_documents(fpath, marker=b'<?xml', block_size=1<<24):
+    offsets = []
+    pos = 0
+    tail = b''
+    with open(fpath, 'rb') as fid:
+        for block in iter(lambda: fid.read(block_size), b''):
+            data = tail + block
+            base = pos - len(tail)
+            i = data.find(marker)
+            while i != -1:
+                offsets.append(base + i)
+                i = data.find(marker, i + 1)
+            tail = data[-(len(marker)-1):]
+            pos += len(block)
+    return offsets
+
+# copy a zip member to a plain file in tmpdir
+def extract_member(fpath, tmpdir):
+    os.makedirs(tmpdir, exist_ok=True)
+    epath = os.path.join(tmpdir, f'{file_tag(fpath)}.extract')
+    with open_file(fpath) as fid, open(f'{epath}.tmp', 'wb') as out:
+        shutil.copyfileobj(fid, out, 1<<24)
+    os.replace(f'{epath}.tmp', epath)
+    return epath
+
+# split into spans of at least size bytes at marker boundaries, zip members are only split
+# when tmpdir is given, by extracting them there first
+def split_file(fpath, size, marker, tmpdir=None):
+    zpath, member = split_zip(fpath)
+    if marker is None or not size:
+        return
+    if member is None:
+        total = os.path.getsize(zpath)
+    elif tmpdir is None:
+        return
+    else:
+        with ZipFile(zpath) as zfile:
+            total = zfile.getinfo(member).file_size
+    if total <= size:
+        return
+
+    source = zpath if member is None else extract_member(fpath, tmpdir)
+    total = os.path.getsize(source)
+    bounds = [0]
+    for off in index_documents(source, marker):
+        if off - bounds[-1] >= size and total - off >= size // 2:
+            bounds.append(off)
+    bounds.append(total)
+
+    if len(bounds) > 2:
+        return [
+            (i, start, stop, False, source)
+            for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))
+        ]
+    elif source != zpath:
+        os.remove(source)
+
+# output path for a table, part files go in a separate directory
+def output_path(output, table, ftag, span=None, format='csv'):
+    ext = table_formats[format]
+    if span is None:
+        return os.path.join(output, f'{table}_{ftag}{ext}')
+    else:
+        return os.path.join(output, '_parts', f'{table}_{ftag}.{span[0]:04d}{ext}')
+
+# see if all outputs exist
+def is_parsed(output, tables, ftag, format='csv'):
+    return all(os.path.exists(output_path(output, tab, ftag, format=format)) for tab in tables)
+
+# content hash of an input file. zip members use their crc, plain files are hashed unless
+# size and mtime match those recorded in old
+def input_hash(fpath, old=None):
+    zpath, member = split_zip(fpath)
+    if member is not None:
+        with ZipFile(zpath) as zfile:
+            info = zfile.getinfo(member)
+        return {'hash': f'crc32:{info.CRC:08x}', 'size': info.file_size}
+
+    stat = os.stat(zpath)
+    size, mtime = stat.st_size, stat.st_mtime_ns
+    if old is not None and old.get('size') == size and old.get('mtime') == mtime:
+        return old
+    digest = hashlib.sha256()
+    with open(zpath, 'rb') as fid:
+        for block in iter(lambda: fid.read(1<<24), b''):
+            digest.update(block)
+    return {'hash': f'sha256:{digest.hexdigest()}', 'size': size, 'mtime': mtime}
+
+# outputs are tagged with the input hash and parser version that produced them
+def tag_path(output, ftag):
+    return os.path.join(output, '_tags', f'{ftag}.json')
+
+def load_tag(output, ftag):
+    tpath = tag_path(output, ftag)
+    if os.path.exists(tpath):
+        with open(tpath) as fid:
+            return json.load(fid)
+
+def save_tag(output, fpath, version, inhash=None):
+    tpath = tag_path(output, file_tag(fpath))
+    os.makedirs(os.path.dirname(tpath), exist_ok=True)
+    inhash = input_hash(fpath) if inhash is None else inhash
+    with open(f'{tpath}.tmp', 'w') as fid:
+        json.dump({'input': inhash, 'version': version}, fid)
+    os.replace(f'{tpath}.tmp', tpath)
+
+def drop_tag(output, fpath):
+    tpath = tag_path(output, file_tag(fpath))
+    if os.path.exists(tpath):
+        os.remove(tpath)
+
+# see if outputs exist and were made from the same input by the same parser version (untagged
+# outputs may be partial or from an older parser, so they are redone). touched but unchanged
+# inputs get their tag updated so they aren't hashed again
+def is_current(output, tables, fpath, version, format='csv'):
+    ftag = file_tag(fpath)
+    if not is_parsed(output, tables, ftag, format=format):
+        return False
+    tag = load_tag(output, ftag)
+    if tag is None or tag['version'] != version:
+        return False
+    inhash = input_hash(fpath, old=tag['input'])
+    if inhash['hash'] != tag['input']['hash']:
+        return False
+    if inhash != tag['input']:
+        save_tag(output, fpath, version, inhash=inhash)
+    return True
+
+# free text columns, the costliest to extract
+text_fields = ['abstract']
+
+# restrict a table schema to the columns in fields (all if None), minus free text columns if
+# not text. returns the schema to write and the columns parsers can skip (required columns
+# feed other tables so they are always extracted)
+def project_schema(schema, fields=None, text=True, required=[]):
+    if fields is None:
+        fields = list(schema)
+    elif type(fields) is str:
+        fields = fields.split(',')
+    unknown = [k for k in fields if k not in schema]
+    if len(unknown) > 0:
+        raise Exception(f'Unknown fields: {", ".join(unknown)}')
+    keep = {k: v for k, v in schema.items() if k in fields and (text or k not in text_fields)}
+    skip = {k for k in schema if k not in keep and k not in required}
+    return keep, skip
+
+# generate (fpath, span) tasks for files that are not current (see is_current), splitting large
+# files, and note the spans of split files
+def plan_tasks(
+    file_list, output, tables, version, split=None, marker=None, overwrite=False, dryrun=False,
+    format='csv'
+):
+    tasks = []
+    splits = {}
+    pardir = os.path.join(output, '_parts')
+    for fpath in file_list:
+        if not overwrite and is_current(output, tables, fpath, version(fpath), format=format):
+            print(f'{file_tag(fpath)}: Skipping')
+            continue
+        if not dryrun:
+            drop_tag(output, fpath)
+        spans = None
+        if split:
+            spans = split_file(fpath, split, marker(fpath), tmpdir=None if dryrun else pardir)
+        if spans is None:
+            tasks.append((fpath, None))
+        else:
+            print(f'{file_tag(fpath)}: Splitting into {len(spans)} parts')
+            tasks += [(fpath, span) for span in spans]
+            splits[fpath] = spans
+
+    if len(splits) > 0 and not dryrun and not os.path.exists(pardir):
+        os.makedirs(pardir)
+
+    return tasks, splits
+
+# parser error state at the end of a part
+def status_path(output, ftag, span):
+    return os.path.join(output, '_parts', f'{ftag}.{span[0]:04d}.err')
+
+def save_status(output, ftag, span, status):
+    with open(status_path(output, ftag, span), 'w') as fid:
+        fid.write('1' if status.get('error', False) else '0')
+
+def load_status(output, ftag, span):
+    spath = status_path(output, ftag, span)
+    if os.path.exists(spath):
+        with open(spath) as fid:
+            return fid.read() == '1'
+    else:
+        return False
+
+# in recover mode libxml2 drops all entity references after its first error, so parts
+# following an error are redone starting in the error state to match a serial parse
+def prime_tasks(output, splits):
+    tasks = []
+    for fpath, spans in splits.items():
+        ftag = file_tag(fpath)
+        error = False
+        for span in spans:
+            if error:
+                tasks.append((fpath, span[:3] + (True,) + span[4:]))
+            error = error or load_status(output, ftag, span)
+    return tasks
+
+# concatenate part outputs in order (header from first part), false if any are missing
+def stitch_parts(output, tables, ftag, spans, format='csv'):
+    paths = {
+        tab: [output_path(output, tab, ftag, span=sp, format=format) for sp in spans]
+        for tab in tables
+    }
+    for span in spans:
+        spath = status_path(output, ftag, span)
+        if os.path.exists(spath):
+            os.remove(spath)
+
+    # extracted zip members are no longer needed either way
+    for source in {sp[4] for sp in spans}:
+        if os.path.dirname(source) == os.path.join(output, '_parts') and os.path.exists(source):
+            os.remove(source)
+
+    if not all(os.path.exists(p) for ps in paths.values() for p in ps):
+        print(f'{ftag}: Incomplete parts')
+        for p in [p for ps in paths.values() for p in ps if os.path.exists(p)]:
+            os.remove(p)
+        return False
+
+    for tab, parts in paths.items():
+        opath = output_path(output, tab, ftag, format=format)
+        tpath = f'{opath}.tmp'
+        join_tables(parts, tpath, format=format)
+        os.replace(tpath, opath)
+        for ppath in parts:
+            os.remove(ppath)
+
+    print(f'{ftag}: Stitched {len(spans)} parts')
+    return True
+
+##
+## scheduling
+##
+
+# bytes to be parsed for a task (uncompressed size for zip members)
+def task_size(task):
+    fpath, span = task
+    if span is not None:
+        return span[2] - span[1]
+    zpath, member = split_zip(fpath)
+    if member is None:
+        return os.path.getsize(zpath)
+    with ZipFile(zpath) as zfile:
+        return zfile.getinfo(member).file_size
+
+# planned parse of one source, parse_task(task) parses a single (fpath, span) task and
+# version(fpath) gives the parser version that split files are tagged with once stitched
+class ParseJob:
+    def __init__(
+        self, parse_task, output, tables, tasks, splits, version, dryrun=False, format='csv'
+    ):
+        self.parse_task = parse_task
+        self.output = output
+        self.tables = tables
+        self.tasks = tasks
+        self.splits = splits
+        self.version = version
+        self.dryrun = dryrun
+        self.format = format
+
+# run the tasks of any number of jobs in one pool, largest first so that no big file is
+# left for the end, then redo primed parts and stitch split files. workers are recycled after
+# max_tasks tasks or above max_rss bytes, and tasks only start while the projected memory use
+# is under max_memory bytes (see WorkerPool)
+def run_jobs(jobs, threads=10, max_tasks=None, max_rss=None, max_memory=None):
+    def run_task(item):
+        k, task = item
+        jobs[k].parse_task(task)
+
+    items = [(k, task) for k, job in enumerate(jobs) for task in job.tasks]
+    sizes = {item: task_size(item[1]) for item in items}
+    items.sort(key=sizes.get, reverse=True)
+    total = sum(sizes.values())
+
+    start = time.monotonic()
+    group = lambda item: item[0]
+    pool = WorkerPool(
+        run_task, threads=threads, max_tasks=max_tasks, max_rss=max_rss, max_memory=max_memory
+    )
+    with pool:
+        pool.run(items, sizes.get, group)
+        primed = [
+            (k, task) for k, job in enumerate(jobs) if not job.dryrun
+            for task in prime_tasks(job.output, job.splits)
+        ]
+        sizes.update({item: task_size(item[1]) for item in primed})
+        pool.run(primed, sizes.get, group)
+
+    for job in jobs:
+        if not job.dryrun:
+            for fpath, spans in job.splits.items():
+                if stitch_parts(job.output, job.tables, file_tag(fpath), spans, format=job.format):
+                    save_tag(job.output, fpath, job.version(fpath))
+
+    elapsed = time.monotonic() - start
+    print(f'Parsed {len(items)} tasks ({total/2**20:.1f}MB) in {elapsed:.1f}s')
 
 ##
 ## xml parsing
 ##
 
+# plain element names
+tag_re = re.compile(r'[\w.-]+')
+
 # get descendent text
 def get_text(parent, tag, default=''):
     child = parent.find(tag)
@@ -26,14 +444,107 @@ def get_text(parent, tag, default=''):
 def raw_text(par, sep=''):
     return sep.join(par.itertext()).strip().lower()
 
+# compiled field lookups for a record type, declared once as field -> path. paths starting
+# with $name are relative to a scope (the first element found at a path, itself possibly
+# scoped), lists of paths are alternatives (first found wins), values are as in get_text.
+# single tags are resolved with one pass over the children of each base element. fields
+# named in skip are not looked up.
+class FieldExtractor:
+    def __init__(self, fields, scopes={}, defaults={}):
+        index = {}
+        self.scopes = []
+        for name, paths in scopes.items():
+            self.scopes.append(self.compile(paths, index))
+            index[name] = len(index)
+        self.fields = [
+            (name, self.compile(paths, index), defaults.get(name, ''))
+            for name, paths in fields.items()
+        ]
+
+    @staticmethod
+    def compile(paths, index):
+        if type(paths) is str:
+            paths = [paths]
+        alts = []
+        for path in paths:
+            scope = None
+            if path.startswith('$'):
+                name, _, path = path[1:].partition('/')
+                scope = index[name]
+            if tag_re.fullmatch(path):
+                alts.append((scope, path, None))
+            else:
+                alts.append((scope, None, XPath(f'({path})[1]')))
+        return alts
+
+    @staticmethod
+    def first(elem, alts, found, children):
+        for scope, tag, xpath in alts:
+            base = elem if scope is None else found[scope]
+            if base is None:
+                continue
+            if xpath is None:
+                if scope not in children:
+                    children[scope] = {c.tag: c for c in base[::-1]}
+                child = children[scope].get(tag)
+                if child is not None:
+                    return child
+            else:
+                match = xpath(base)
+                if len(match) > 0:
+                    return match[0]
+
+    def __call__(self, elem, skip=()):
+        found = []
+        children = {}
+        for alts in self.scopes:
+            found.append(self.first(elem, alts, found, children))
+        values = {}
+        for name, alts, default in self.fields:
+            if name in skip:
+                continue
+            child = self.first(elem, alts, found, children)
+            if child is None or child.text is None:
+                values[name] = default
+            else:
+                values[name] = child.text.strip().lower()
+        return values
+
 # preserve memory
 def clear(elem):
     elem.clear()
     while elem.getprevious() is not None:
         del elem.getparent()[0]
 
-# parse mangled xml
-def parse_wrapper(fpath, main_tag, parser):
+# feed an undefined entity to put the parser in its error state
+prime_xml = '<fastpat-prime>&fastpat;</fastpat-prime>\n'
+
+# entity references are dropped in the error state
+probe_xml = '<fastpat-probe>&amp;</fastpat-probe>\n'
+
+# declaration lines dropped from concatenated documents (matched with the preceding
+# newline, which is much faster than a multiline anchor)
+preamble_re = re.compile(rb'\n(?:<\?xml|<!DOCTYPE|<!ENTITY|\]>).*')
+
+# strip declarations from a run of whole lines and decode
+def clean_block(data):
+    return preamble_re.sub(b'', b'\n'+data)[1:].decode('utf-8', errors='ignore')
+
+# whole lines of a file in large blocks, cleaned and decoded, optionally filtered first
+def read_blocks(fid, block_size=1<<18, drop=None):
+    tail = b''
+    for block in iter(lambda: fid.read(block_size), b''):
+        data = tail + block
+        cut = data.rfind(b'\n') + 1
+        data, tail = data[:cut], data[cut:]
+        if len(data) > 0:
+            yield clean_block(data if drop is None else drop(data))
+    if len(tail) > 0:
+        yield clean_block(tail if drop is None else drop(tail))
+
+# parse mangled xml, optionally only a span of the file (primed spans start in the error
+# state), with status['error'] recording whether the parser ended in the error state
+def parse_wrapper(fpath, main_tag, parser, span=None, status=None, block_size=1<<18):
     _, fname = os.path.split(fpath)
     pp = XMLPullParser(tag=main_tag, events=['end'], recover=True)
     def parse_all():
@@ -41,19 +552,165 @@ def parse_wrapper(fpath, main_tag, parser):
             yield parser(pat, fname)
             clear(pat)
 
-    with open(fpath, errors='ignore') as f:
+    with open_file(fpath, span=span) as f:
         pp.feed('<root>\n')
-        for line in f:
-            if line.startswith('<?xml'):
-                yield from parse_all()
-            elif line.startswith('<!DOCTYPE') or line.startswith('<!ENTITY') or line.startswith(']>'):
-                pass
+        if span is not None and span[3]:
+            pp.feed(prime_xml)
+
+        for text in read_blocks(f, block_size=block_size):
+            pp.feed(text)
+            yield from parse_all()
+
+        if status is not None:
+            pp.feed(probe_xml)
+        pp.feed('</root>\n')
+        yield from parse_all()
+
+    if status is not None:
+        probe = pp.close().find('.//fastpat-probe')
+        status['error'] = probe is None or probe.text != '&'
+
+# characters that can follow a tag name
+tag_ends = (b' ', b'\t', b'\r', b'\n', b'>', b'/')
+
+# drop whole sections (which must not nest in themselves) from a stream of blocks
+class SectionFilter:
+    def __init__(self, tags):
+        self.tags = [(f'<{t}'.encode(), f'</{t}>'.encode()) for t in tags]
+        self.inside = None
+
+    @staticmethod
+    def find_open(data, tag, pos):
+        i = data.find(tag, pos)
+        while i != -1 and data[i+len(tag):i+len(tag)+1] not in tag_ends:
+            i = data.find(tag, i+1)
+        return i
+
+    def __call__(self, data):
+        keep = []
+        pos = 0
+        nexts = [self.find_open(data, op, 0) for op, _ in self.tags]
+        while True:
+            # skip to end of current section
+            if self.inside is not None:
+                i = data.find(self.inside, pos)
+                if i == -1:
+                    return b''.join(keep)
+                pos = i + len(self.inside)
+                self.inside = None
+
+            # find next section
+            for k, (op, _) in enumerate(self.tags):
+                if nexts[k] != -1 and nexts[k] < pos:
+                    nexts[k] = self.find_open(data, op, pos)
+            found = [(i, k) for k, i in enumerate(nexts) if i != -1]
+            if len(found) == 0:
+                keep.append(data[pos:])
+                return b''.join(keep)
+            i, k = min(found)
+            keep.append(data[pos:i])
+
+            # empty element or start of section
+            j = data.find(b'>', i)
+            if j != -1 and data[j-1:j] == b'/':
+                pos = j + 1
             else:
-                pp.feed(line)
-        else:
-            pp.feed('</root>\n')
+                pos = i
+                self.inside = self.tags[k][1]
+
+# parser target building each record from selected top-level sections only, the rest is
+# never turned into elements (also picks up the error probe, see parse_wrapper)
+class RecordTarget:
+    def __init__(self, main_tag, keep):
+        self.main_tag = main_tag
+        self.keep = set(keep)
+        self.records = []
+        self.builder = None
+        self.depth = 0
+        self.skip = 0
+        self.probe = None
+        self.in_probe = False
+
+    def start(self, tag, attrib):
+        if self.builder is not None:
+            self.depth += 1
+            if self.skip == 0:
+                if self.depth == 2 and tag not in self.keep:
+                    self.skip = self.depth
+                else:
+                    self.builder.start(tag, attrib)
+        elif tag == self.main_tag:
+            self.builder = TreeBuilder()
+            self.builder.start(tag, attrib)
+            self.depth = 1
+        elif tag == 'fastpat-probe':
+            self.probe = []
+            self.in_probe = True
+
+    def end(self, tag):
+        if self.builder is not None:
+            self.depth -= 1
+            if self.skip > 0:
+                if self.depth < self.skip:
+                    self.skip = 0
+            else:
+                self.builder.end(tag)
+                if self.depth == 0:
+                    self.records.append(self.builder.close())
+                    self.builder = None
+        elif tag == 'fastpat-probe':
+            self.in_probe = False
+
+    def data(self, text):
+        if self.builder is not None:
+            if self.skip == 0:
+                self.builder.data(text)
+        elif self.in_probe:
+            self.probe.append(text)
+
+    def comment(self, text):
+        if self.builder is not None and self.skip == 0:
+            self.builder.comment(text)
+
+    def pi(self, target, data=None):
+        if self.builder is not None and self.skip == 0:
+            self.builder.pi(target, data)
+
+    def close(self):
+        pass
+
+# like parse_wrapper, but records only contain the keep sections and the skip sections
+# are cut from the input before parsing, so only the kept parts are ever parsed
+def parse_target(
+    fpath, main_tag, parser, keep, skip=[], span=None, status=None, block_size=1<<18
+):
+    _, fname = os.path.split(fpath)
+    target = RecordTarget(main_tag, keep)
+    pp = XMLParser(target=target, recover=True)
+    drop = SectionFilter(skip) if len(skip) > 0 else None
+    def parse_all():
+        records, target.records = target.records, []
+        for pat in records:
+            yield parser(pat, fname)
+
+    with open_file(fpath, span=span) as f:
+        pp.feed('<root>\n')
+        if span is not None and span[3]:
+            pp.feed(prime_xml)
+
+        for text in read_blocks(f, block_size=block_size, drop=drop):
+            pp.feed(text)
             yield from parse_all()
 
+        if status is not None:
+            pp.feed(probe_xml)
+        pp.feed('</root>\n')
+        pp.close()
+        yield from parse_all()
+
+    if status is not None:
+        status['error'] = target.probe is None or ''.join(target.probe) != '&'
+
 ##
 ## patnum parsers
 ##
@@ -105,10 +762,19 @@ def gen3g_ipc(ipcsec):
         yield ipc.text or ''
 
 # apply and grant (3)
+fields_ipcr = FieldExtractor({
+    'section': 'section',
+    'class': 'class',
+    'subclass': 'subclass',
+    'group': 'main-group',
+    'subgroup': 'subgroup',
+})
+
 def gen3r_ipc(ipcsec):
     for ipc in ipcsec.findall('classification-ipcr'):
-        yield get_text(ipc, 'section') + get_text(ipc, 'class') + get_text(ipc, 'subclass') \
-            + get_text(ipc, 'main-group').zfill(3) + '/' + get_text(ipc, 'subgroup')
+        ipr = fields_ipcr(ipc)
+        yield ipr['section'] + ipr['class'] + ipr['subclass'] \
+            + ipr['group'].zfill(3) + '/' + ipr['subgroup']
 
 ##
 ## cite parsers
@@ -119,14 +785,19 @@ def gen2_cite(refs):
     for cite in refs.findall('B561'):
         yield get_text(cite, 'PCIT/DOC/DNUM/PDAT')
 
+# document ids (cites and assignments)
+fields_docid = FieldExtractor({
+    'country': 'country',
+    'kind': 'kind',
+    'pnum': 'doc-number',
+})
+
 # grant (3)
 def gen3_cite(refs, prefix):
     for cite in refs.findall(prefix+'citation/patcit/document-id'):
-        natl = get_text(cite, 'country')
-        kind = get_text(cite, 'kind')
-        pnum = get_text(cite, 'doc-number')
-        if natl == 'us' and kind != '00': # US granted patents only
-            yield pnum
+        doc = fields_docid(cite)
+        if doc['country'] == 'us' and doc['kind'] != '00': # US granted patents only
+            yield doc['pnum']
 
 ##
 ## assign parsers
@@ -134,10 +805,9 @@ def gen3_cite(refs, prefix):
 
 def gen3_assign(patents):
     for doc in patents.findall('patent-property/document-id'):
-        kind = get_text(doc, 'kind')
-        pnum = get_text(doc, 'doc-number')
-        if kind.startswith('b'):
-            yield pnum
+        doc = fields_docid(doc)
+        if doc['kind'].startswith('b'):
+            yield doc['pnum']
 
 # detect organization type
 ORG_CORP = 0
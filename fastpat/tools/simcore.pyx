@@ -1,3 +1,6 @@
+cimport cython
+from libc.stdlib cimport malloc, free, abs
+
 DEF dim = 64
 
 cdef unsigned long masks[dim]
@@ -32,3 +35,129 @@ def simcore(hashish, weights):
             ans |= masks[j]
 
     return ans
+
+# signatures of many items at once: the features of item k are hashes[offsets[k]:offsets[k+1]]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def simbatch(
+    const unsigned long long[:] hashes, const float[:] weights, const long long[:] offsets,
+    unsigned long long[:] out
+):
+    cdef Py_ssize_t n = out.shape[0]
+    cdef Py_ssize_t i, j, k
+    cdef unsigned long long ans
+    cdef unsigned long long h
+    cdef float w
+    cdef float u[dim]
+
+    with nogil:
+        for k in range(n):
+            for j in range(dim):
+                u[j] = 0.0
+
+            for i in range(offsets[k], offsets[k+1]):
+                h = hashes[i]
+                w = weights[i]
+                # sign by multiplication rather than branching on random bits
+                for j in range(dim):
+                    u[j] += w*<float>(2*<int>((h >> j) & 1) - 1)
+
+            ans = 0
+            for j in range(dim):
+                if u[j] >= 0:
+                    ans |= masks[j]
+            out[k] = ans
+
+# edit distance of a and b if at most k, otherwise k+1. pairs are first rejected when
+# their lengths or character counts (bucketed by code point) differ by more than k, then
+# only the diagonal band of width 2k+1 is filled in, stopping once every cell of a row is
+# more than k from the end (counting the edits needed to get back to the last diagonal)
+DEF nhist = 64
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def levenshtein_within(str a, str b, int k):
+    cdef Py_ssize_t n = len(a)
+    cdef Py_ssize_t m = len(b)
+    cdef Py_ssize_t i, j, lo, hi
+    cdef int hist[nhist]
+    cdef int pos, neg, cost, val, low
+    cdef Py_UCS4 c
+    cdef unsigned int code
+    cdef int *buf
+    cdef Py_UCS4 *sa
+    cdef Py_UCS4 *sb
+    cdef int *prev
+    cdef int *cur
+    cdef int *tmp
+    cdef int big = k + 1
+
+    if n > m:
+        a, b = b, a
+        n, m = m, n
+    if m - n > k:
+        return big
+
+    for j in range(nhist):
+        hist[j] = 0
+    for i in range(n):
+        c = a[i]
+        code = c
+        hist[code % nhist] += 1
+    for j in range(m):
+        c = b[j]
+        code = c
+        hist[code % nhist] -= 1
+    pos = neg = 0
+    for j in range(nhist):
+        if hist[j] > 0:
+            pos += hist[j]
+        else:
+            neg -= hist[j]
+    if pos > k or neg > k:
+        return big
+
+    buf = <int*>malloc(2*(m+2)*sizeof(int) + (n+m)*sizeof(Py_UCS4))
+    if buf == NULL:
+        raise MemoryError()
+    prev = buf
+    cur = buf + (m+2)
+    sa = <Py_UCS4*>(buf + 2*(m+2))
+    sb = sa + n
+    for i in range(n):
+        sa[i] = a[i]
+    for j in range(m):
+        sb[j] = b[j]
+    for j in range(m+2):
+        prev[j] = j if j <= k else big
+
+    for i in range(1, n+1):
+        lo = max(1, i-k)
+        hi = min(m, i+k)
+        cur[lo-1] = i if lo == 1 else big
+        low = i + abs(m - (n-i)) if lo == 1 else big
+        c = sa[i-1]
+        for j in range(lo, hi+1):
+            cost = 0 if c == sb[j-1] else 1
+            val = prev[j-1] + cost
+            if prev[j] + 1 < val:
+                val = prev[j] + 1
+            if cur[j-1] + 1 < val:
+                val = cur[j-1] + 1
+            if val > big:
+                val = big
+            cur[j] = val
+            val += abs((m-j) - (n-i))
+            if val < low:
+                low = val
+        cur[hi+1] = big
+        if low > k:
+            free(buf)
+            return big
+        tmp = prev
+        prev = cur
+        cur = tmp
+
+    val = prev[m] if prev[m] < big else big
+    free(buf)
+    return val
@@ -2,9 +2,10 @@
 # locally sensitive hashing code
 #
 
-from collections import defaultdict
+from itertools import combinations
 import numpy as np
 import xxhash
+from editdistance import eval as levenshtein
 
 # add current path
 import os
@@ -18,7 +19,7 @@ try:
     pyximport.install(language_level=3)
     import simcore as simcore
 except:
-    pass
+    simcore = None
 
 # k-shingles: pairs of adjacent k-length substrings (in order)
 def shingle(s, k=2):
@@ -31,7 +32,42 @@ def tokenize(s):
     return s.split()
 
 def murmur(x):
-    return np.uint64(xxhash.xxh64_intdigest(x))
+    return np.uint64(xxhash.xxh64_intdigest(x.encode('utf-8')))
+
+# memoized feature hashes. features seen again while a generation fills move up to the
+# new one, so shingles and common words stay cached while the long tail of words ages out
+class HashVocab(dict):
+    def __init__(self, size=1<<20):
+        super().__init__()
+        self.size = size
+        self.old = {}
+        self.lookups = 0
+        self.misses = 0
+
+    def __missing__(self, f):
+        h = self.old.get(f)
+        if h is None:
+            h = xxhash.xxh64_intdigest(f.encode('utf-8'))
+            self.misses += 1
+        if len(self) >= self.size:
+            self.old = dict(self)
+            self.clear()
+        self[f] = h
+        return h
+
+    def hashes(self, features):
+        self.lookups += len(features)
+        return np.fromiter(map(self.__getitem__, features), dtype=np.uint64, count=len(features))
+
+    def hit_rate(self):
+        return 1.0 - self.misses/self.lookups if self.lookups > 0 else 0.0
+
+    def report(self):
+        cached = len(self) + len(self.old)
+        print(f'feature hashes: {self.lookups} lookups, {self.hit_rate():.1%} hits, {cached} cached')
+
+# shared by default
+feature_vocab = HashVocab()
 
 # compute actual simhash
 class Simhash:
@@ -56,47 +92,216 @@ class Simhash:
 
 # compute actual simhash with C - only 64 width
 class CSimhash():
-    def __init__(self):
+    def __init__(self, vocab=None):
         self.simcore = simcore.simcore
+        self.vocab = vocab if vocab is not None else feature_vocab
 
     def simhash(self, features, weights=None):
         if weights is None:
             weights = [1.0]*len(features)
-        hashish = [murmur(f) for f in features]
+        hashish = self.vocab.hashes(features)
         ret = np.uint64(self.simcore(hashish, weights))
         return ret
 
+# weights falling linearly from 1 to 0 within runs of given lengths (same as np.linspace)
+def linear_weights(counts):
+    counts = np.asarray(counts, dtype=np.int64)
+    group = np.repeat(np.arange(len(counts)), counts)
+    pos = np.arange(counts.sum()) - (np.cumsum(counts) - counts)[group]
+    size = counts[group]
+    step = -1.0/np.maximum(size-1, 1)
+    weights = pos*step + 1.0
+    weights[(pos == size-1) & (size > 1)] = 0.0
+    return weights
+
+# flat features of a column of names: the shingles then the words of each, each weighted
+# linearly from 1 to 0. the features of name k are at offsets[k]:offsets[k+1]
+def name_features(names, nshingle=2):
+    features = []
+    counts = np.zeros(2*len(names), dtype=np.int64)
+    for k, name in enumerate(names):
+        shings = list(shingle(name, nshingle))
+        words = tokenize(name)
+        features += shings
+        features += words
+        counts[2*k] = len(shings)
+        counts[2*k+1] = len(words)
+    offsets = np.zeros(len(names)+1, dtype=np.int64)
+    np.cumsum(counts[0::2]+counts[1::2], out=offsets[1:])
+    return features, linear_weights(counts), offsets
+
+# numpy version of simcore.simbatch: adds up in float32 and in feature order, so the
+# signatures are identical. items are processed in blocks to bound the memory
+def simbatch_numpy(hashes, weights, offsets, out, block=1<<14):
+    dim = 64
+    masks = np.uint64(1) << np.arange(dim, dtype=np.uint64)
+    counts = np.diff(offsets)
+    for k0 in range(0, len(out), block):
+        k1 = min(k0+block, len(out))
+        start, size = offsets[k0:k1], counts[k0:k1]
+        v = np.zeros((k1-k0, dim), dtype=np.float32)
+        for i in range(size.max(initial=0)):
+            rows = np.flatnonzero(size > i)
+            h, w = hashes[start[rows]+i], weights[start[rows]+i]
+            v[rows] += np.where((h[:,None] & masks) != 0, w[:,None], -w[:,None])
+        out[k0:k1] = np.bitwise_or.reduce(np.where(v >= 0, masks, np.uint64(0)), axis=1)
+    return out
+
+# signatures of many items from flat feature hashes and weights
+def simhash_batch(hashes, weights, offsets):
+    hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+    weights = np.ascontiguousarray(weights, dtype=np.float32)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    out = np.zeros(len(offsets)-1, dtype=np.uint64)
+    if simcore is not None:
+        simcore.simbatch(hashes, weights, offsets, out)
+    else:
+        simbatch_numpy(hashes, weights, offsets, out)
+    return out
+
+# signatures of a column of names, in chunks to bound the memory
+def simhash_names(names, nshingle=2, chunk=1<<20, vocab=None):
+    vocab = vocab if vocab is not None else feature_vocab
+    names = list(names)
+    signs = np.zeros(len(names), dtype=np.uint64)
+    for k in range(0, len(names), chunk):
+        features, weights, offsets = name_features(names[k:k+chunk], nshingle=nshingle)
+        signs[k:k+chunk] = simhash_batch(vocab.hashes(features), weights, offsets)
+    return signs
+
+# edit distance if at most k, otherwise k+1 (bounded early exit with simcore)
+def levenshtein_within(s1, s2, k):
+    if simcore is not None:
+        return simcore.levenshtein_within(s1, s2, k)
+    return min(levenshtein(s1, s2), k+1)
+
+# runs of equal sorted keys: their ends and sizes
+def bucket_runs(keys):
+    ends = np.append(np.flatnonzero(keys[1:] != keys[:-1]) + 1, len(keys))
+    size = np.diff(ends, prepend=0)
+    return ends, size
+
+# pairs of positions (p, q) with p < q <= p + later[p], in chunks of about the given number
+# of pairs
+def bucket_pairs(later, chunk=1<<22):
+    n = len(later)
+    total = np.cumsum(later)
+    start = 0
+    while start < n:
+        base = total[start-1] if start > 0 else 0
+        stop = max(start+1, np.searchsorted(total, base+chunk, side='right'))
+        count = later[start:stop]
+        first = np.repeat(np.arange(start, stop), count)
+        step = np.arange(len(first)) - np.repeat(np.cumsum(count) - count, count) + 1
+        yield first, first + step
+        start = stop
+
 class Cluster:
-    # dim is the simhash width, k is the tolerance
-    def __init__(self, dim=64, k=4, thresh=1):
+    # dim is the simhash width, k is the number of bands, and items are united when more
+    # than thresh bands match. buckets larger than max_bucket (if any) are hot: their items
+    # are ordered by simhash and each is only compared with the next window items
+    def __init__(
+        self, dim=64, k=4, thresh=1, vocab=None, max_bucket=None, window=100, chunk=1<<22
+    ):
         self.dim = dim
         self.k = k
         self.thresh = thresh
+        self.max_bucket = max_bucket
+        self.window = window
+        self.chunk = chunk
 
-        self.unions = []
-        self.hashmaps = [defaultdict(list) for _ in range(k)] # defaultdict(list)
+        self.signs = []
+        self.labels = []
+        self.found = None
         self.offsets = [np.uint64(dim//k*i) for i in range(k)]
         self.bin_masks = [np.uint64(2**(dim-offset)-1) if (i == len(self.offsets)-1) else np.uint64(2**(self.offsets[i+1]-offset)-1) for i, offset in enumerate(self.offsets)]
+        self.band_masks = [mask << offset for offset, mask in zip(self.offsets, self.bin_masks)]
 
-        self.csim = CSimhash()
+        self.csim = CSimhash(vocab=vocab)
+        self.vocab = self.csim.vocab
         self.hasher = self.csim.simhash
 
     # add item to the cluster
     def add(self, features, label, weights=None):
-        # get subkeys
         sign = self.hasher(features, weights)
-        keyvec = self.get_keys(sign)
-
-        # Unite labels with the same keys in the same band
-        matches = defaultdict(int)
-        for idx, key in enumerate(keyvec):
-            others = self.hashmaps[idx][key]
-            for l in others:
-                matches[l] += 1
-            others.append(label)
-        for out, val in matches.items():
-           if val > self.thresh:
-               self.unions.append((label, out))
+        self.insert(sign, label)
+
+    # add item with known simhash
+    def insert(self, sign, label):
+        self.insert_many([sign], [label])
+
+    # add items with known simhashes
+    def insert_many(self, signs, labels):
+        self.signs.append(np.asarray(signs, dtype=np.uint64))
+        self.labels.append(np.asarray(labels))
+        self.found = None
+
+    # pairs (label, earlier label) matching in more than thresh bands, ordered as if each
+    # item were compared with the earlier ones in its band buckets as it is added
+    @property
+    def unions(self):
+        if self.found is None:
+            self.found = self.find_unions()
+        return self.found
+
+    # such a pair matches exactly on some thresh+1 bands, so it shares a bucket of the
+    # signatures masked to those. it is only kept under the first thresh+1 bands it matches
+    def find_unions(self):
+        signs = np.concatenate(self.signs) if len(self.signs) > 0 else np.zeros(0, dtype=np.uint64)
+        labels = np.concatenate(self.labels) if len(self.labels) > 0 else np.zeros(0, dtype=np.int64)
+        self.signs, self.labels = [signs], [labels]
+
+        # bucket stats and hot buckets as (bands, key, size, label)
+        self.candidates = 0
+        self.largest = 0
+        self.hot = []
+
+        left, right, band = [], [], []
+        for combo in combinations(range(self.k), max(0, self.thresh)+1):
+            mask = np.bitwise_or.reduce(np.array([self.band_masks[b] for b in combo]))
+            skip = [b for b in range(combo[-1]) if b not in combo]
+
+            order = np.argsort(signs & mask)
+            keys = signs[order] & mask
+            ends, size = bucket_runs(keys)
+            later = np.repeat(ends, size) - np.arange(len(keys)) - 1
+            self.largest = max(self.largest, size.max(initial=0))
+
+            if self.max_bucket is not None:
+                hot = size > self.max_bucket
+                for end, num in zip(ends[hot], size[hot]):
+                    items = order[end-num:end]
+                    order[end-num:end] = items[np.argsort(signs[items], kind='stable')]
+                    later[end-num:end] = np.minimum(later[end-num:end], self.window)
+                    self.hot.append((combo, keys[end-1], num, labels[items.min()]))
+
+            self.candidates += later.sum()
+            for p, q in bucket_pairs(later, chunk=self.chunk):
+                i, j = np.minimum(order[p], order[q]), np.maximum(order[p], order[q])
+                diff = signs[i] ^ signs[j]
+                first = np.ones(len(diff), dtype=bool)
+                for b in skip:
+                    first &= (diff & self.band_masks[b]) != 0
+                left.append(j[first])
+                right.append(i[first])
+                band.append(np.full(first.sum(), combo[0]))
+
+        if len(left) == 0:
+            return []
+        left, right, band = np.concatenate(left), np.concatenate(right), np.concatenate(band)
+        order = np.lexsort((right, band, left))
+        return list(zip(labels[left[order]].tolist(), labels[right[order]].tolist()))
+
+    # bucket stats, and the largest hot buckets with a sample item (or its name)
+    def report(self, top=10, names=None):
+        if self.found is None:
+            self.found = self.find_unions()
+        print(f'band buckets: {self.candidates} candidate pairs, largest bucket {self.largest}')
+        if len(self.hot) > 0:
+            print(f'{len(self.hot)} hot buckets (over {self.max_bucket} items)')
+        for bands, key, num, label in sorted(self.hot, key=lambda h: -h[2])[:top]:
+            sample = names[label] if names is not None else label
+            print(f'bands {bands}, key {key:016x}: {num} items, e.g. {sample}')
 
     # bin simhash into chunks
     def get_keys(self, simhash):
@@ -0,0 +1,69 @@
+# pipelined fetching and parsing
+
+import os
+import time
+import threading
+from contextlib import closing
+from fnmatch import fnmatch
+from multiprocessing import Pool
+
+from .fetch import fetch_iter
+from .parse import zip_members
+from .tables import check_format
+
+# files in a downloaded archive that the parser wants
+def match_members(zpath, patterns):
+    members = zip_members(zpath)
+    return [
+        m for pat in patterns for m in sorted(members) if fnmatch(os.path.basename(m), pat)
+    ]
+
+# parse each file as soon as it is downloaded, with at most queue files waiting on the parsers
+def sync_many(
+    files, rawdir, output, parse_file, patterns, threads=10, fetch_threads=4, rate=0.2,
+    queue=None, display=1_000, overwrite=False, dryrun=False, format='csv', **kwargs
+):
+    queue = 2*threads if queue is None else queue
+    check_format(format)
+
+    # ensure output dir
+    if not dryrun and not os.path.exists(output):
+        print(f'Creating directory {output}')
+        os.makedirs(output)
+
+    # bound number of files waiting to be parsed
+    slots = threading.BoundedSemaphore(queue)
+    def release(_):
+        slots.release()
+
+    nfile = 0
+    failed = []
+    start = time.monotonic()
+    opts = {'display': display, 'overwrite': overwrite, 'dryrun': dryrun, 'format': format}
+
+    # start pool before fetch threads so workers fork cleanly
+    with Pool(threads) as pool:
+        # closed on errors too, so fetch threads don't wait on a consumer that is gone
+        stream = fetch_iter(
+            files, rawdir, threads=fetch_threads, rate=rate, queue=queue, dryrun=dryrun,
+            failed=failed, **kwargs
+        )
+        with closing(stream):
+            for zpath, _ in stream:
+                if not os.path.isfile(zpath):
+                    continue
+                for fpath in match_members(zpath, patterns):
+                    slots.acquire()
+                    pool.apply_async(
+                        parse_file, (fpath, output), opts, callback=release,
+                        error_callback=release
+                    )
+                    nfile += 1
+
+        pool.close()
+        pool.join()
+
+    elapsed = time.monotonic() - start
+    print(f'Synced {nfile} files in {elapsed:.1f}s')
+    if len(failed) > 0:
+        raise Exception(f'Failed to fetch {len(failed)} files: {", ".join(failed)}')
@@ -1,7 +1,13 @@
 # tools for patent data
 
+import io
 import os
+import csv
+import gzip
+import json
+import shutil
 import pandas as pd
+from itertools import chain
 
 # csv types
 dtypes = {
@@ -33,11 +39,347 @@ dtypes = {
     'ever_large': 'boolean',
 }
 
-# read csv with proper types
-def read_csv(fname, **kwargs):
+# table file formats and their extensions
+table_formats = {
+    'csv': '.csv',
+    'csv.gz': '.csv.gz',
+    'csv.zst': '.csv.zst',
+    'parquet': '.parquet',
+}
+
+# parquet column types
+arrow_types = {
+    'str': 'string',
+    'int': 'int64',
+}
+
+# parquet support is optional
+def import_arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception('Parquet tables require pyarrow (pip install pyarrow)')
+    return pa, pq
+
+# zstd support is optional
+def import_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('Zstd tables require zstandard (pip install zstandard)')
+    return zstandard
+
+# fail early on unknown or unsupported formats
+def check_format(format):
+    if format not in table_formats:
+        raise Exception(f'Unknown table format: {format}')
+    if format == 'parquet':
+        import_arrow()
+    elif format == 'csv.zst':
+        import_zstd()
+
+# format of a table file from its extension
+def table_format(path):
+    path = os.fspath(path)
+    for fmt, ext in sorted(table_formats.items(), key=lambda x: -len(x[1])):
+        if path.endswith(ext):
+            return fmt
+
+# existing file for a table path in any format or a virtual table (the newest if there are
+# several), so that readers can ask for name.csv and get whatever the earlier stage wrote
+def find_table(path):
+    path = os.fspath(path)
+    fmt = table_format(path)
+    if fmt is None:
+        return path
+    base = path[:-len(table_formats[fmt])]
+    exts = list(table_formats.values()) + [manifest_ext]
+    found = [base + ext for ext in exts if os.path.exists(base + ext)]
+    if len(found) == 0:
+        return path
+    return max(found, key=os.path.getmtime)
+
+# open a csv table for text (or bytes if mode has b), (de)compressing as a stream by format
+# (from the extension if None)
+def open_table(path, mode='r', format=None, buffer_size=1<<20):
+    fmt = table_format(path) if format is None else format
+    text = {} if 'b' in mode else {'encoding': 'utf-8', 'newline': ''}
+    tmode = mode if 'b' in mode else f'{mode}t'
+    if fmt == 'csv.gz':
+        return gzip.open(path, tmode, compresslevel=6, **text)
+    elif fmt == 'csv.zst':
+        zstd = import_zstd()
+        fid = zstd.open(path, tmode, **text)
+        return io.BufferedReader(fid) if tmode == 'rb' else fid
+    else:
+        return open(path, mode, buffering=buffer_size, **text)
+
+# virtual tables are a manifest of the files that make them up
+manifest_ext = '.parts.json'
+
+# csv files read back to back as one (uncompressed) file, skipping all but the first header
+class PartsReader(io.RawIOBase):
+    def __init__(self, paths, format='csv'):
+        self.paths = paths
+        self.format = format
+        self.index = 0
+        self.fid = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self.index < len(self.paths):
+            if self.fid is None:
+                self.fid = open_table(self.paths[self.index], 'rb', format=self.format)
+                if self.index > 0:
+                    self.fid.readline()
+            size = self.fid.readinto(buf)
+            if size > 0:
+                return size
+            self.fid.close()
+            self.fid = None
+            self.index += 1
+        return 0
+
+    def close(self):
+        if self.fid is not None:
+            self.fid.close()
+            self.fid = None
+        super().close()
+
+def load_manifest(mpath):
+    with open(mpath) as fid:
+        return json.load(fid)
+
+# list paths as a virtual table at mpath (paths are stored relative to it). all must have the
+# same columns, files already in the manifest with the same size and mtime aren't checked again
+def save_manifest(paths, mpath, format='csv'):
+    mdir = os.path.dirname(os.path.abspath(mpath))
+    old = load_manifest(mpath) if os.path.exists(mpath) else {}
+    known = {
+        p['path']: (p['size'], p['mtime']) for p in old.get('parts', [])
+        if old['format'] == format
+    }
+
+    header = None
+    parts = []
+    for ppath in paths:
+        rpath = os.path.relpath(ppath, mdir)
+        stat = os.stat(ppath)
+        if header is None or known.get(rpath) != (stat.st_size, stat.st_mtime_ns):
+            cols = table_header(ppath, format=format)
+            header = cols if header is None else header
+            if cols != header:
+                raise Exception(f'Header mismatch: {ppath}')
+        parts.append({'path': rpath, 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+
+    with open(f'{mpath}.tmp', 'w') as fid:
+        json.dump({'format': format, 'columns': header, 'parts': parts}, fid, indent=1)
+    os.replace(f'{mpath}.tmp', mpath)
+
+# read a virtual table, csv parts are parsed as one stream so types are inferred as they
+# would be for a real concatenation
+def read_manifest(mpath, dtype={}, **kwargs):
+    manifest = load_manifest(mpath)
+    mdir = os.path.dirname(os.path.abspath(mpath))
+    paths = [os.path.join(mdir, p['path']) for p in manifest['parts']]
+    if manifest['format'] == 'parquet':
+        frames = [read_parquet(p, dtype=dtype, **kwargs) for p in paths]
+        if kwargs.get('chunksize') is None:
+            return pd.concat(frames, ignore_index=True)
+        else:
+            return chain.from_iterable(frames)
+    else:
+        stream = io.BufferedReader(PartsReader(paths, format=manifest['format']), 1<<20)
+        return pd.read_csv(stream, dtype=dtype, **kwargs)
+
+# read parquet with the given types (columns are otherwise typed as written, where csv would
+# infer them), usecols keeps file order like read_csv
+def read_parquet(fname, dtype={}, usecols=None, chunksize=None):
+    pa, pq = import_arrow()
+    if usecols is not None:
+        usecols = [c for c in pq.read_schema(fname).names if c in usecols]
+
+    def convert(table):
+        frame = table.to_pandas()
+        return frame.astype({k: v for k, v in dtype.items() if k in frame})
+
+    if chunksize is None:
+        return convert(pq.read_table(fname, columns=usecols))
+    else:
+        pfile = pq.ParquetFile(fname)
+        return (convert(b) for b in pfile.iter_batches(batch_size=chunksize, columns=usecols))
+
+# plain csv tables read with read_csv are cached next to them in uncompressed feather, which
+# is mapped into memory rather than parsed on later reads. the cache is keyed on the size and
+# mtime of the table and the types asked for, and columns are added to it as they are read.
+# compressed and virtual tables are not cached, as an uncompressed copy would undo the point
+# of them (and a virtual one would be rebuilt whenever a file is added)
+cache_ext = '.cache.feather'
+
+def cache_key(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+# cached table (memory mapped) and its columns that are still valid
+def open_cache(cpath, key, types):
+    pa, _ = import_arrow()
+    if not os.path.exists(cpath):
+        return None, []
+    try:
+        table = pa.ipc.open_file(pa.memory_map(cpath)).read_all()
+        meta = json.loads(table.schema.metadata[b'fastpat'])
+    except (pa.ArrowException, KeyError):
+        return None, []
+    if meta['key'] != key:
+        return None, []
+    return table, [c for c in table.column_names if meta['types'].get(c) == types.get(c)]
+
+def save_cache(frame, cpath, key, types):
+    pa, _ = import_arrow()
+    from pyarrow import feather
+    try:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        meta = {**table.schema.metadata, b'fastpat': json.dumps({'key': key, 'types': types})}
+        table = table.replace_schema_metadata(meta)
+        feather.write_feather(table, f'{cpath}.tmp', compression='uncompressed')
+        os.replace(f'{cpath}.tmp', cpath)
+    except (pa.ArrowException, OSError):
+        pass
+
+# read columns through the cache, parsing only those not in it (none if pyarrow is missing or
+# the table isn't plain csv)
+def read_cached(fname, dtype={}, usecols=None):
+    if table_format(fname) != 'csv':
+        return
+    try:
+        import_arrow()
+    except Exception:
+        return
+    header = table_header(fname)
+
+    # unknown columns are left for read_csv to report
+    if usecols is not None and not set(usecols) <= set(header):
+        return
+    want = [c for c in header if usecols is None or c in usecols]
+    types = {c: str(dtype[c]) for c in header if c in dtype}
+
+    cpath = f'{fname}{cache_ext}'
+    key = cache_key(fname)
+    table, valid = open_cache(cpath, key, types)
+    missing = [c for c in want if c not in valid]
+    if len(missing) == 0:
+        return table.select(want).to_pandas()
+
+    # rebuild with the parsed columns added, the only time the cache is written (and only
+    # if the directory is writable)
+    fresh = pd.read_csv(fname, dtype=dtype, usecols=missing)
+    if len(valid) > 0:
+        fresh = pd.concat([table.select(valid).to_pandas(), fresh], axis=1)
+    fresh = fresh[[c for c in header if c in fresh]]
+    if os.access(os.path.dirname(os.path.abspath(cpath)), os.W_OK):
+        save_cache(fresh, cpath, key, types)
+    return fresh[want]
+
+# read table with proper types (any format or virtual, see find_table). plain reads of
+# uncompressed csv tables (all columns or usecols) go through the cache unless cache is false
+def read_csv(fname, cache=True, **kwargs):
     dt = {**dtypes, **kwargs.pop('dtype', {})}
+    fname = find_table(fname)
+    if cache and set(kwargs) <= {'usecols'}:
+        frame = read_cached(fname, dtype=dt, **kwargs)
+        if frame is not None:
+            return frame
+    if fname.endswith(manifest_ext):
+        return read_manifest(fname, dtype=dt, **kwargs)
+    elif table_format(fname) == 'parquet':
+        return read_parquet(fname, dtype=dt, **kwargs)
     return pd.read_csv(fname, dtype=dt, **kwargs)
 
+# write a whole frame (kwargs only apply to csv)
+def write_frame(frame, path, format='csv', **kwargs):
+    if format == 'parquet':
+        import_arrow()
+        frame.to_parquet(path, index=False)
+    else:
+        frame.to_csv(path, index=False, **kwargs)
+
+# column names of a table file
+def table_header(path, format=None):
+    fmt = table_format(path) if format is None else format
+    if fmt == 'parquet':
+        _, pq = import_arrow()
+        return pq.read_schema(path).names
+    with open_table(path, format=fmt) as fid:
+        return next(csv.reader(fid), [])
+
+# append table files into one at opath, csv headers are taken from the first file and
+# parquet row groups are copied as is (compressed csv is recompressed). all files must have
+# the same columns. with key, only the first row for each (non-missing) value of the key
+# column is kept, and the number of rows dropped is returned
+def join_tables(paths, opath, format='csv', key=None):
+    header = table_header(paths[0], format=format)
+    for ppath in paths[1:]:
+        if table_header(ppath, format=format) != header:
+            raise Exception(f'Header mismatch: {ppath}')
+
+    seen = set()
+    dropped = 0
+
+    def keep(value):
+        nonlocal dropped
+        if value is None or value == '':
+            return True
+        elif value in seen:
+            dropped += 1
+            return False
+        else:
+            seen.add(value)
+            return True
+
+    if format == 'parquet':
+        pa, pq = import_arrow()
+        writer = None
+        for ppath in paths:
+            pfile = pq.ParquetFile(ppath)
+            if writer is None:
+                writer = pq.ParquetWriter(opath, pfile.schema_arrow)
+            for i in range(pfile.num_row_groups):
+                group = pfile.read_row_group(i)
+                if key is not None:
+                    mask = [keep(x) for x in group.column(key).to_pylist()]
+                    group = group.filter(pa.array(mask))
+                writer.write_table(group)
+        writer.close()
+    elif key is not None:
+        col = header.index(key)
+        with open_table(opath, 'w', format=format) as fout:
+            writer = csv.writer(fout, lineterminator='\n')
+            writer.writerow(header)
+            for ppath in paths:
+                with open_table(ppath, format=format) as fin:
+                    reader = csv.reader(fin)
+                    next(reader)
+                    writer.writerows(row for row in reader if keep(row[col]))
+    elif format == 'csv':
+        with open(opath, 'wb') as fout:
+            for i, ppath in enumerate(paths):
+                with open(ppath, 'rb') as fin:
+                    if i > 0:
+                        fin.readline()
+                    shutil.copyfileobj(fin, fout, 1<<20)
+    else:
+        with open_table(opath, 'w', format=format) as fout:
+            for i, ppath in enumerate(paths):
+                with open_table(ppath, format=format) as fin:
+                    if i > 0:
+                        fin.readline()
+                    shutil.copyfileobj(fin, fout, 1<<20)
+
+    return dropped
+
 def astype(data, dtype):
     if dtype == 'str':
         return pd.Series(data, dtype='str')
@@ -46,9 +388,32 @@ def astype(data, dtype):
     else:
         raise Exception(f'Unsupported type: {dtype}')
 
-# insert in chunks
+# same values as astype for the common cases (str as is, ints and plain digit strings as
+# int, empty as missing), None if astype is needed
+def lean_column(data, dtype):
+    types = set(map(type, data))
+    if dtype == 'str':
+        if types == {str}:
+            return data
+    elif dtype == 'int':
+        if types == {int} and -2**53 < min(data) and max(data) < 2**53:
+            return data
+        vals = []
+        for x in data:
+            if type(x) is int and -2**53 < x < 2**53:
+                vals.append(x)
+            elif type(x) is str and x.isdigit() and x.isascii() and len(x) < 16:
+                vals.append(int(x))
+            elif x == '':
+                vals.append('')
+            else:
+                return
+        return vals
+
+# insert in chunks. rows are written with the csv module directly, which is what to_csv
+# uses, and chunks with values that need pandas conversion go through pandas
 class ChunkWriter:
-    def __init__(self, path, schema, chunk_size=1000, output=False):
+    def __init__(self, path, schema, chunk_size=1000, output=False, buffer_size=1<<20):
         self.path = path
         self.schema = schema
         self.chunk_size = chunk_size
@@ -57,12 +422,13 @@ class ChunkWriter:
         self.i = 0
         self.j = 0
 
-        self.file = open(self.path, 'w+', encoding='utf-8')
+        self.file = open_table(self.path, 'w', buffer_size=buffer_size)
+        self.writer = csv.writer(self.file, lineterminator='\n')
         header = ','.join(schema)
         self.file.write(f'{header}\n')
 
     def __del__(self):
-        self.file.close()
+        self.close()
 
     def insert(self, *args):
         self.items.append(args)
@@ -91,15 +457,70 @@ class ChunkWriter:
             print(f'Committing chunk {self.i} to {self.table} ({len(self.items)})')
 
         data = [x for x in zip(*self.items)]
-        frame = pd.DataFrame({k: astype(d, v) for (k, v), d in zip(self.schema.items(), data)})
-        frame.to_csv(self.file, index=False, header=False)
+        lean = [lean_column(d, v) for d, v in zip(data, self.schema.values())]
+        if all(d is not None for d in lean):
+            self.writer.writerows(zip(*lean))
+        else:
+            frame = pd.DataFrame({k: astype(d, v) for (k, v), d in zip(self.schema.items(), data)})
+            frame.to_csv(self.file, index=False, header=False)
 
         self.items.clear()
 
-    def delete(self):
+    def close(self):
         self.file.close()
+
+    def delete(self):
+        self.close()
         os.remove(self.path)
 
+# insert in chunks, each chunk is a parquet row group (so chunks are larger by default)
+class ParquetWriter(ChunkWriter):
+    def __init__(self, path, schema, chunk_size=20_000, output=False):
+        pa, pq = import_arrow()
+        self.path = path
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.output = output
+        self.items = []
+        self.i = 0
+        self.j = 0
+
+        self.arrow = pa.schema([(k, arrow_types[v]) for k, v in schema.items()])
+        self.writer = pq.ParquetWriter(self.path, self.arrow)
+
+    def commit(self):
+        self.i += 1
+        self.j += len(self.items)
+
+        if len(self.items) == 0:
+            return
+
+        if self.output:
+            print(f'Committing chunk {self.i} to {self.table} ({len(self.items)})')
+
+        # empty strings are missing, as they are when read back from csv
+        pa, _ = import_arrow()
+        data = [[None if x == '' else x for x in d] for d in zip(*self.items)]
+        columns = [
+            pa.array(astype(d, v), type=t)
+            for d, v, t in zip(data, self.schema.values(), self.arrow.types)
+        ]
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.arrow))
+
+        self.items.clear()
+
+    def close(self):
+        if self.writer.is_open:
+            self.writer.close()
+
+# table writers by format
+table_writers = {
+    'csv': ChunkWriter,
+    'csv.gz': ChunkWriter,
+    'csv.zst': ChunkWriter,
+    'parquet': ParquetWriter,
+}
+
 # pretend to insert in chunks
 class DummyWriter:
     def __init__(self, *args, chunk_size=1000, output=False, **kwargs):
@@ -132,5 +553,8 @@ class DummyWriter:
             print(self.last)
         self.i = 0
 
+    def close(self):
+        pass
+
     def delete(self):
         pass
@@ -0,0 +1,168 @@
+# worker processes with memory limits
+
+import os
+import resource
+from traceback import print_exc
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+
+# resident memory of this process in bytes
+def get_rss():
+    try:
+        with open('/proc/self/statm') as fid:
+            return int(fid.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# peak resident memory since the last reset (lifetime peak where reset is unsupported)
+def get_peak():
+    try:
+        with open('/proc/self/status') as fid:
+            for line in fid:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as fid:
+            fid.write('5')
+    except OSError:
+        pass
+
+# worker side: run items until told to stop, reporting memory after each
+def worker_loop(conn, func):
+    conn.send(get_rss())
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+        start = get_rss()
+        reset_peak()
+        try:
+            func(item)
+        except Exception:
+            print_exc()
+        conn.send((start, get_peak(), get_rss()))
+    conn.close()
+
+class Worker:
+    def __init__(self, func):
+        self.conn, child = Pipe()
+        self.proc = Process(target=worker_loop, args=(child, func), daemon=True)
+        self.proc.start()
+        child.close()
+        self.base = self.conn.recv()
+        self.rss = self.base
+        self.tasks = 0
+        self.item = None
+        self.growth = 0
+
+    def send(self, item, growth):
+        self.item = item
+        self.growth = growth
+        self.conn.send(item)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.proc.join()
+
+# process pool that recycles workers after max_tasks tasks or when left holding more than
+# max_rss bytes, and only starts a task when the projected memory of the pool stays under
+# max_memory. a task is projected to grow its worker by ratio times its size, where ratio
+# starts at ratio0 and is then the largest growth per byte seen in its group. memory is
+# counted as the parent plus what each worker holds beyond its memory at startup
+class WorkerPool:
+    def __init__(
+        self, func, threads=10, max_tasks=None, max_rss=None, max_memory=None, ratio0=1.0
+    ):
+        self.func = func
+        self.threads = threads
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.max_memory = max_memory
+        self.ratio0 = ratio0
+        self.ratios = {}
+        self.workers = []
+
+    def __enter__(self):
+        self.workers = [Worker(self.func) for _ in range(self.threads)]
+        return self
+
+    def __exit__(self, *args):
+        for w in self.workers:
+            w.stop()
+        self.workers = []
+
+    def growth(self, size, group):
+        return self.ratios.get(group, self.ratio0) * size
+
+    def in_use(self):
+        held = sum(max(0, w.rss - w.base) + w.growth for w in self.workers)
+        return get_rss() + held
+
+    # first task (in order) that fits under the memory budget, anything fits on an idle pool
+    def admit(self, pending, size, group):
+        if self.max_memory is None:
+            return 0
+        busy = any(w.item is not None for w in self.workers)
+        free = self.max_memory - self.in_use()
+        for i, item in enumerate(pending):
+            if not busy or self.growth(size(item), group(item)) <= free:
+                return i
+
+    # run items in order as workers and memory allow (size and group map items to their
+    # size in bytes and memory group)
+    def run(self, items, size, group):
+        pending = list(items)
+        while len(pending) > 0 or any(w.item is not None for w in self.workers):
+            # start tasks on idle workers
+            for w in self.workers:
+                if len(pending) == 0:
+                    break
+                if w.item is not None:
+                    continue
+                i = self.admit(pending, size, group)
+                if i is None:
+                    break
+                item = pending.pop(i)
+                w.send(item, self.growth(size(item), group(item)))
+
+            # wait for any to finish
+            busy = {w.conn: w for w in self.workers if w.item is not None}
+            for conn in wait(list(busy)):
+                self.finish(busy[conn], size, group)
+
+    # collect memory report, learn growth ratio, and recycle worker if needed
+    def finish(self, w, size, group):
+        item = w.item
+        try:
+            start, peak, rss = w.conn.recv()
+        except EOFError:
+            print(f'Worker {w.proc.pid} died running {item}')
+            self.replace(w)
+            return
+
+        nbytes, kind = size(item), group(item)
+        if nbytes > 0:
+            ratio = max(0, peak - start) / nbytes
+            self.ratios[kind] = max(ratio, self.ratios.get(kind, 0))
+        w.item = None
+        w.growth = 0
+        w.rss = rss
+        w.tasks += 1
+
+        if self.max_tasks is not None and w.tasks >= self.max_tasks:
+            self.replace(w)
+        elif self.max_rss is not None and rss > self.max_rss:
+            print(f'Worker {w.proc.pid} recycled at {rss/2**20:.0f}MB')
+            self.replace(w)
+
+    def replace(self, w):
+        w.stop()
+        self.workers[self.workers.index(w)] = Worker(self.func)
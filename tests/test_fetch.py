@@ -0,0 +1,94 @@
+# fetch against a local server that can cut responses short
+
+import os
+import json
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from fastpat.tools.fetch import fetch_many, fetch_iter
+
+body = os.urandom(50_020)
+
+class Handler(BaseHTTPRequestHandler):
+    truncate = True
+
+    def do_GET(self):
+        start = 0
+        rng = self.headers.get('Range')
+        if rng is not None:
+            start = int(rng.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body)-1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)-start))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+
+        # advertise the full length but close after a tenth of it
+        data = body[start:]
+        if Handler.truncate:
+            data = data[:len(body)//10]
+        self.wfile.write(data)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{srv.server_port}'
+    srv.shutdown()
+    srv.server_close()
+
+def test_truncated_download(server, tmp_path):
+    url = f'{server}/file.zip'
+    zpath = tmp_path / 'file.zip'
+
+    Handler.truncate = True
+    with pytest.raises(Exception, match='Failed to fetch 1 files'):
+        fetch_many([url], tmp_path, rate=100)
+
+    # not moved into place or recorded, but kept to resume from
+    manifest = json.loads((tmp_path / 'manifest.json').read_text())
+    assert not zpath.exists()
+    assert 'file.zip' not in manifest
+    assert 'file.zip.part' in manifest
+    assert (tmp_path / 'file.zip.part').stat().st_size == len(body)//10
+
+    # the next run resumes and completes it
+    Handler.truncate = False
+    fetch_many([url], tmp_path, rate=100)
+    manifest = json.loads((tmp_path / 'manifest.json').read_text())
+    assert zpath.read_bytes() == body
+    assert manifest['file.zip']['size'] == len(body)
+    assert 'file.zip.part' not in manifest
+
+# consumers that stop early with downloads still queued must not leave workers blocked
+def test_consumer_stops_early(server, tmp_path):
+    Handler.truncate = False
+    urls = [f'{server}/file{i}.zip' for i in range(8)]
+    errors = []
+
+    def stop_at_first(output):
+        for zpath, size in fetch_iter(urls, output, threads=4, rate=100, queue=1):
+            break
+
+    def fail_at_first(output):
+        try:
+            for zpath, size in fetch_iter(urls, output, threads=4, rate=100, queue=1):
+                raise ValueError('parse failed')
+        except ValueError as e:
+            errors.append(e)
+
+    # the generator returns (or the error propagates) instead of hanging
+    for consume, output in [(stop_at_first, tmp_path / 'a'), (fail_at_first, tmp_path / 'b')]:
+        thread = threading.Thread(target=consume, args=(output,), daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    assert len(errors) == 1
@@ -0,0 +1,106 @@
+# projected grant parses match the full parse restricted to the kept columns
+
+import pytest
+import pandas as pd
+
+from fastpat.parse.grant import parse_file
+
+gen1 = '''HHHHHT  APS1
+PATN
+WKU  039302163
+SRC  5
+APN  1868701
+APD  19750603
+TTL  alpha composition
+ISD  19760106
+NCL  9
+ASSG
+NAM  Beta Corporation
+CTY  Albany
+STA  NY
+CLAS
+EDF  2
+ICL  G06F 413
+UREF
+PNO  3445924
+ABST
+PAL  alpha beta
+PATN
+WKU  039302171
+SRC  12
+APN  2451083
+APD  19750138
+TTL  gamma method
+ISD  19760106
+NCL  7
+ASSG
+NAM  Delta GmbH
+CTY  Munich
+CNT  DEX
+CLAS
+EDF  2
+ICL  H04L 008
+ABST
+PAL  gamma delta
+PATN
+WKU  039302180
+SRC  12
+APN  2451084
+APD  19750139
+TTL  widget
+ISD  19760106
+NCL  3
+PATN
+'''
+
+gen3_doc = '''<?xml version="1.0" encoding="UTF-8"?>
+<us-patent-grant lang="EN">
+<us-bibliographic-data-grant>
+<publication-reference><document-id><country>US</country><doc-number>{pn}</doc-number><kind>B2</kind><date>20200107</date></document-id></publication-reference>
+<application-reference><document-id><country>US</country><doc-number>16123456</doc-number><date>20180301</date></document-id></application-reference>
+<classification-ipc><edition>07</edition><main-classification>G06F 18/53</main-classification></classification-ipc>
+<invention-title>Beta widget</invention-title>
+<references-cited></references-cited>
+<number-of-claims>20</number-of-claims>
+<assignees><assignee><addressbook><orgname>Widget Inc.</orgname><address><city>Delta</city>{state}<country>{country}</country></address></addressbook></assignee></assignees>
+</us-bibliographic-data-grant>
+<abstract><p>alpha composition</p></abstract>
+<description><p>method</p></description>
+</us-patent-grant>
+'''
+gen3 = ''.join([
+    gen3_doc.format(pn='10524567', state='<state>CA</state>', country='US'),
+    gen3_doc.format(pn='10524568', state='', country='JP'),
+])
+
+files = {
+    'pftaps19760106_wk01.dat': gen1,
+    'ipgb20200107_wk01.xml': gen3,
+}
+
+projections = ['patnum,country', 'patnum,state', 'patnum,title,owner', 'country']
+
+def read_grant(output, fname):
+    ftag = fname.rsplit('.', 1)[0]
+    return pd.read_csv(output / f'grant_{ftag}.csv', dtype=str, keep_default_na=False)
+
+@pytest.mark.parametrize('fname, engine', [
+    ('pftaps19760106_wk01.dat', 'tree'),
+    ('ipgb20200107_wk01.xml', 'tree'),
+    ('ipgb20200107_wk01.xml', 'target'),
+])
+def test_projection(tmp_path, fname, engine):
+    fpath = tmp_path / fname
+    fpath.write_text(files[fname], encoding='latin1')
+
+    (tmp_path / 'full').mkdir()
+    parse_file(str(fpath), tmp_path / 'full', engine=engine)
+    full = read_grant(tmp_path / 'full', fname)
+    assert len(full) > 1
+
+    for i, fields in enumerate(projections):
+        output = tmp_path / f'proj{i}'
+        output.mkdir()
+        parse_file(str(fpath), output, engine=engine, fields=fields)
+        proj = read_grant(output, fname)
+        pd.testing.assert_frame_equal(proj, full[list(proj.columns)])
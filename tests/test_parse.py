@@ -0,0 +1,48 @@
+# splitting files into spans at document boundaries
+
+import os
+import zipfile
+
+from fastpat.tools.parse import split_file, open_file, stitch_parts
+
+docs = [f'<?xml version="1.0"?>\n<doc id="{i}">{"x"*(100+i)}</doc>\n'.encode() for i in range(50)]
+data = b''.join(docs)
+
+def read_spans(fpath, spans):
+    parts = []
+    for span in spans:
+        with open_file(fpath, span=span) as fid:
+            parts.append(fid.read())
+    return parts
+
+def test_split_plain(tmp_path):
+    fpath = tmp_path / 'docs.xml'
+    fpath.write_bytes(data)
+
+    spans = split_file(fpath, 1000, b'<?xml')
+    parts = read_spans(fpath, spans)
+    assert len(spans) > 2
+    assert b''.join(parts) == data
+    assert all(p.startswith(b'<?xml') for p in parts)
+
+# zip members are extracted to tmpdir to be split and the copy is removed once stitched
+def test_split_zip(tmp_path):
+    zpath = tmp_path / 'docs.zip'
+    with zipfile.ZipFile(zpath, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        zfile.writestr('docs.xml', data)
+    fpath = os.path.join(zpath, 'docs.xml')
+    output = tmp_path / 'out'
+    pardir = os.path.join(output, '_parts')
+
+    assert split_file(fpath, 1000, b'<?xml') is None
+    spans = split_file(fpath, 1000, b'<?xml', tmpdir=pardir)
+    assert len(spans) > 2
+    assert b''.join(read_spans(fpath, spans)) == data
+
+    assert not stitch_parts(str(output), ['docs'], 'docs', spans)
+    assert os.listdir(pardir) == []
+
+    # members that are not worth splitting are not left behind
+    assert split_file(fpath, len(data), b'<?xml', tmpdir=pardir) is None
+    assert split_file(fpath, len(data) - 10, b'<?xml', tmpdir=pardir) is None
+    assert os.listdir(pardir) == []
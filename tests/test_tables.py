@@ -0,0 +1,69 @@
+# read_csv through the feather cache
+
+import pytest
+import pandas as pd
+
+from fastpat.tools import tables
+from fastpat.tools.tables import read_csv, save_manifest, cache_ext
+
+pytest.importorskip('pyarrow')
+
+@pytest.fixture
+def saves(monkeypatch):
+    calls = []
+    save_cache = tables.save_cache
+    def counted(frame, cpath, key, types):
+        calls.append(list(frame.columns))
+        save_cache(frame, cpath, key, types)
+    monkeypatch.setattr(tables, 'save_cache', counted)
+    return calls
+
+def test_cache_written_on_rebuild_only(tmp_path, saves):
+    path = tmp_path / 'grant_grant.csv'
+    frame = pd.DataFrame({'patnum': ['1', '2', '3'], 'owner': ['a', 'b', None], 'n': [1, 2, 3]})
+    frame.to_csv(path, index=False)
+
+    first = read_csv(str(path), usecols=['patnum', 'owner'])
+    assert saves == [['patnum', 'owner']]
+
+    # valid hits leave the cache alone
+    stat = (tmp_path / f'grant_grant.csv{cache_ext}').stat()
+    hit = read_csv(str(path), usecols=['patnum', 'owner'])
+    read_csv(str(path), usecols=['owner'])
+    assert len(saves) == 1
+    assert (tmp_path / f'grant_grant.csv{cache_ext}').stat().st_mtime_ns == stat.st_mtime_ns
+    pd.testing.assert_frame_equal(hit, first)
+
+    # new columns rebuild it, after which full reads are hits
+    full = read_csv(str(path))
+    assert saves[1] == ['patnum', 'owner', 'n']
+    read_csv(str(path))
+    assert len(saves) == 2
+    pd.testing.assert_frame_equal(full, read_csv(str(path), cache=False))
+
+    # a changed table rebuilds it
+    frame.iloc[:2].to_csv(path, index=False)
+    assert len(read_csv(str(path))) == 2
+    assert len(saves) == 3
+
+def test_cache_skipped_when_read_only(tmp_path, saves, monkeypatch):
+    path = tmp_path / 'name.csv'
+    pd.DataFrame({'id': [0, 1], 'name': ['x', 'y']}).to_csv(path, index=False)
+    monkeypatch.setattr(tables.os, 'access', lambda path, mode: False)
+
+    frame = read_csv(str(path))
+    assert list(frame['name']) == ['x', 'y']
+    assert saves == []
+    assert not (tmp_path / f'name.csv{cache_ext}').exists()
+
+# an uncompressed copy would undo compressed and virtual tables, so only plain csv is cached
+def test_cache_plain_csv_only(tmp_path, saves):
+    frame = pd.DataFrame({'patnum': ['1', '2', '3'], 'owner': ['a', 'b', 'c']})
+    frame.to_csv(tmp_path / 'grant_a.csv.gz', index=False)
+    frame.to_csv(tmp_path / 'grant_b.csv', index=False)
+    save_manifest([tmp_path / 'grant_b.csv'], tmp_path / 'grant_c.parts.json')
+
+    for name in ['grant_a.csv.gz', 'grant_c.parts.json']:
+        pd.testing.assert_frame_equal(read_csv(str(tmp_path / name)), frame)
+        assert not (tmp_path / f'{name}{cache_ext}').exists()
+    assert saves == []